@@ -0,0 +1,256 @@
+"""
+Microbenchmarks of the forecasting and budget optimization paths.
+
+Runs offline against data/cpi_data.csv and a synthetic (seeded) population of budgets, reports latency
+percentiles and peak memory of each benchmark and saves the results as json so runs on different commits
+can be compared. Run from the backend folder:
+
+    python benchmark.py --output results.json
+    python benchmark.py --output new.json --compare results.json
+"""
+import argparse
+import functools
+import gc
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "package", "src", "scripts")
+
+
+# synthetic budgets, with the fields of BudgetInput in experta-system-v2.py
+def make_budgets(n, seed=0):
+    rng = np.random.default_rng(seed)
+    budgets = []
+    for _ in range(n):
+        take_home = float(rng.choice(np.arange(2000, 12001, 50)))
+        shares = rng.dirichlet(np.ones(7)) * rng.uniform(0.6, 1.0)
+        transport, food, housing, insurance, other_needs, investment, savings = (take_home * shares).round()
+        budgets.append({
+            "age": int(rng.integers(21, 70)),
+            "number_of_kids": int(rng.integers(0, 4)),
+            "monthly_take_home": take_home,
+            "planning_to_buy_home": bool(rng.random() < 0.3),
+            "repaying_home_loans": bool(rng.random() < 0.4),
+            "supporting_aged_parents": bool(rng.random() < 0.3),
+            "owns_car": bool(rng.random() < 0.3),
+            "transport_expenditure": float(transport),
+            "food_expenditure": float(food),
+            "housing_expenditure": float(housing),
+            "insurance_expenditure": float(insurance),
+            "other_needs_expenditure": float(other_needs),
+            "emergency_funds": float(rng.uniform(0, 12) * take_home),
+            "investment_expenditure": float(investment),
+            "monthly_savings": float(savings),
+        })
+    return budgets
+
+
+# synthetic expenditure states, with the fields of PredictionEngine
+def make_states(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return [{
+        "food": float(rng.uniform(200, 1500)),
+        "transport": float(rng.uniform(50, 600)),
+        "use_public_transport": bool(rng.random() < 0.7),
+        "utilities": float(rng.uniform(0, 300)),
+        "discretionary": float(rng.uniform(0, 1500)),
+        "housing": float(rng.uniform(0, 3000)),
+        "invest": float(rng.uniform(0, 1000)),
+        "take_home": float(rng.uniform(2000, 12000)),
+    } for _ in range(n)]
+
+
+# helper function, imports a module from the scripts folder (experta-system-v2 is not a valid module name)
+def load_script(module_name, filename):
+    if SCRIPTS_DIR not in sys.path:
+        sys.path.insert(0, SCRIPTS_DIR)
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(SCRIPTS_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# times fn on each input (cycling through inputs for repeat calls after warmup calls), then measures the
+# peak memory allocated by one more call, returns the statistics in milliseconds and bytes
+def run_benchmark(fn, inputs, repeat, warmup=1):
+    for i in range(warmup):
+        fn(inputs[i % len(inputs)])
+    gc.collect()
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn(inputs[i % len(inputs)])
+        timings.append(time.perf_counter() - start)
+    # tracemalloc slows down allocations, so memory is measured separately from the timings
+    tracemalloc.start()
+    fn(inputs[0])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings = np.array(timings) * 1000
+    return {
+        "calls": repeat,
+        "mean_ms": float(timings.mean()),
+        "p50_ms": float(np.percentile(timings, 50)),
+        "p90_ms": float(np.percentile(timings, 90)),
+        "p99_ms": float(np.percentile(timings, 99)),
+        "max_ms": float(timings.max()),
+        "peak_memory_bytes": int(peak),
+    }
+
+
+# returns the benchmarks as name -> setup, a function returning (function taking one input, inputs, number of
+# calls), so that only the benchmarks that are run are set up, and what several of them use is set up once
+def get_benchmarks(quick):
+    scale = 10 if quick else 1
+
+    @functools.cache
+    def get_models():
+        from prediction_engine import ForecastModels
+
+        return ForecastModels()
+
+    @functools.cache
+    def get_engines():
+        from prediction_engine import PredictionEngine
+
+        return [PredictionEngine(**state, models=get_models()) for state in make_states(200)]
+
+    @functools.cache
+    def get_budgets():
+        return make_budgets(200)
+
+    @functools.cache
+    def get_script(module_name, filename):
+        return load_script(module_name, filename)
+
+    def advise(budget):
+        expert_system = get_script("experta_system_v2", "experta-system-v2.py")
+        engine = expert_system.BudgetAdvisor()
+        engine.reset()
+        engine.declare(expert_system.BudgetInfo(**budget))
+        engine.run()
+        return engine.recommendations
+
+    # construction with the models and forecasts loaded from the cache (filled by get_models), and with
+    # everything refitted
+    def load():
+        from prediction_engine import ForecastModels
+
+        get_models()
+        return lambda _: ForecastModels(), [None], max(3, 20 // scale)
+
+    def fit():
+        from prediction_engine import ForecastModels
+
+        def fit_models(_):
+            with tempfile.TemporaryDirectory() as cache_dir:
+                ForecastModels(cache_dir=cache_dir)
+        return fit_models, [None], 1 if quick else 3
+
+    # the numpy forecaster fits every data series, not only those of the models
+    def fit_numpy():
+        from forecasters import NumpyForecaster
+        from prediction_engine import ForecastModels
+
+        return lambda _: ForecastModels(forecaster=NumpyForecaster()), [None], max(3, 20 // scale)
+
+    def construct():
+        from prediction_engine import PredictionEngine
+
+        models = get_models()
+        return lambda state: PredictionEngine(**state, models=models), make_states(200), 2000 // scale
+
+    # the rules evaluated over a table of budgets (checked against the engine in package/src/scripts/tests)
+    def analyze_100k():
+        budget_rules = get_script("budget_rules", "budget_rules.py")
+        table = pd.DataFrame(make_budgets(100000, seed=1))
+        table["valid"] = True
+        return budget_rules.analyze_budgets, [table], max(3, 20 // scale)
+
+    return {
+        "forecast_models.load": load,
+        "forecast_models.fit": fit,
+        "forecast_models.fit_numpy": fit_numpy,
+        "prediction_engine.construct": construct,
+        "prediction_engine.predict_expenditure": lambda: (lambda e: e.predict_expenditure("food", 6), get_engines(), 2000 // scale),
+        "prediction_engine.predict_total_expenditure": lambda: (lambda e: e.predict_total_expenditure(6), get_engines(), 2000 // scale),
+        "prediction_engine.predict_cumulative_savings": lambda: (lambda e: e.predict_cumulative_savings(6), get_engines(), 2000 // scale),
+        # what the savings page needs, separately and in one pass
+        "prediction_engine.savings_page": lambda: (
+            lambda e: (e.predict_total_expenditure(1), e.predict_cumulative_savings(6)), get_engines(), 2000 // scale),
+        "prediction_engine.predict_dashboard": lambda: (lambda e: e.predict_dashboard([1, 6]), get_engines(), 2000 // scale),
+        "prediction_engine.predict_long_horizon": lambda: (lambda e: e.predict_long_horizon(480, "yearly"), get_engines(), 2000 // scale),
+        "prediction_engine.simulate_cumulative_savings": lambda: (lambda e: e.simulate_cumulative_savings(12, seed=0), get_engines(), 100 // scale),
+        "csp_solver.optimize": lambda: (
+            get_script("csp_solver_v4", "csp_solver_v4.py").optimize_budget_with_weighted_quadratic_loss_custom_units,
+            get_budgets(), 2000 // scale),
+        "csp_solver.optimize_cp_sat": lambda: (
+            lambda budget: get_script("csp_solver_v4", "csp_solver_v4.py").optimize_budget_with_weighted_quadratic_loss_custom_units(budget, solver="cp_sat"),
+            get_budgets(), 200 // scale),
+        "budget_advisor.run": lambda: (advise, get_budgets(), 1000 // scale),
+        # with the engines reused, as /analyze-budget runs them
+        "budget_advisor.run_reused": lambda: (get_script("experta_system_v2", "experta-system-v2.py").advise, get_budgets(), 1000 // scale),
+        "budget_rules.analyze_100k": analyze_100k,
+    }
+
+
+# helper function, commit of the working tree (if it is a git repository)
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the forecasting and budget optimization paths.")
+    parser.add_argument("--output", help="save the results to this json file")
+    parser.add_argument("--compare", help="json file of a previous run to compare against")
+    parser.add_argument("--only", help="only run benchmarks whose name contains this")
+    parser.add_argument("--quick", action="store_true", help="run fewer calls per benchmark")
+    args = parser.parse_args()
+
+    results = {}
+    for name, setup in get_benchmarks(args.quick).items():
+        if args.only and args.only not in name:
+            continue
+        fn, inputs, repeat = setup()
+        results[name] = run_benchmark(fn, inputs, repeat)
+        r = results[name]
+        print(f"{name:50s} p50 {r['p50_ms']:10.3f}ms  p99 {r['p99_ms']:10.3f}ms  peak {r['peak_memory_bytes'] / 2**20:8.2f}MiB")
+
+    report = {
+        "commit": get_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        print(f"\ncompared to {previous.get('commit')} (p50, >1 is slower):")
+        for name, r in results.items():
+            if name in previous["results"]:
+                ratio = r["p50_ms"] / previous["results"][name]["p50_ms"]
+                print(f"{name:50s} {ratio:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
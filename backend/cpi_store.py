@@ -0,0 +1,106 @@
+import csv
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+STORE_DIR = "data/cpi_store"
+
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+# helper function, hash of the csv file the store was converted from
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# converts the wide cpi csv (one row per data series, one column per month, newest month first) into a
+# compact store in store_dir:
+#   values.npy  - float32 matrix of series x month (oldest month first), NaN where there is no data
+#   months.npy  - month index (year * 12 + month - 1) of each column
+#   series.json - name of each row and the hash of the csv it was converted from
+def convert(csv_path, store_dir=STORE_DIR):
+    with open(csv_path, newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = [row for row in reader if row]
+
+    months = []
+    for column in header[1:]:
+        year, mth = column.strip().split(" ")
+        months.append(int(year) * 12 + MONTHS.index(mth))
+    order = np.argsort(months)
+
+    names = [row[0].strip() for row in rows]
+    values = np.array(
+        [[np.nan if v.strip() in ("", "na") else float(v) for v in row[1:]] for row in rows],
+        dtype=np.float32,
+    )[:, order]
+
+    # write to temporary files first so readers never see a partially written store
+    os.makedirs(store_dir, exist_ok=True)
+    tmp = f".{os.getpid()}.tmp"
+    with open(os.path.join(store_dir, "values.npy" + tmp), "wb") as f:
+        np.save(f, values)
+    with open(os.path.join(store_dir, "months.npy" + tmp), "wb") as f:
+        np.save(f, np.array(months, dtype=np.int32)[order])
+    with open(os.path.join(store_dir, "series.json" + tmp), "w") as f:
+        json.dump({"source_hash": hash_file(csv_path), "series": names}, f)
+    # series.json is replaced last, its source hash marks the store as complete
+    for filename in ["values.npy", "months.npy", "series.json"]:
+        os.replace(os.path.join(store_dir, filename + tmp), os.path.join(store_dir, filename))
+
+
+# read-only view of a converted store, the values are memory-mapped rather than read into memory
+class CPIStore():
+    def __init__(self, store_dir=STORE_DIR):
+        with open(os.path.join(store_dir, "series.json")) as f:
+            meta = json.load(f)
+        self.source_hash = meta["source_hash"]
+        self.series_names = meta["series"]
+        self.series_index = {name: i for i, name in enumerate(self.series_names)}
+        self.months = np.load(os.path.join(store_dir, "months.npy"))
+        self.values = np.load(os.path.join(store_dir, "values.npy"), mmap_mode="r")
+
+    # returns the month indices and values of the months the series has data for
+    def get(self, series_name):
+        row = self.values[self.series_index[series_name]]
+        has_data = ~np.isnan(row)
+        return self.months[has_data], row[has_data]
+
+    # returns the series as a dataframe with columns ds (first day of each month) and y, as prophet expects
+    def get_frame(self, series_name):
+        months, values = self.get(series_name)
+        return pd.DataFrame({
+            "ds": (months - 1970 * 12).astype("datetime64[M]").astype("datetime64[ns]"),
+            "y": values.astype(np.float64),
+        })
+
+
+# opens the store converted from csv_path, converting the csv first if the store is missing or out of date
+def load_store(csv_path, store_dir=STORE_DIR):
+    source_hash = hash_file(csv_path)
+    try:
+        store = CPIStore(store_dir)
+        if store.source_hash == source_hash:
+            return store
+    except (OSError, ValueError, KeyError):
+        pass
+    convert(csv_path, store_dir)
+    return CPIStore(store_dir)
+
+
+if __name__ == "__main__":
+    import sys
+
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else "data/cpi_data.csv"
+    store_dir = sys.argv[2] if len(sys.argv) > 2 else STORE_DIR
+    convert(csv_path, store_dir)
+    store = CPIStore(store_dir)
+    print(f"converted {len(store.series_names)} series x {len(store.months)} months into {store_dir}")
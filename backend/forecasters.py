@@ -0,0 +1,201 @@
+import statistics
+import time
+
+import numpy as np
+import pandas as pd
+
+import shared_modules  # noqa: F401, makes metrics, offload and profiling importable
+from metrics import observe_stage, stage_timer
+
+# parameters of models fitted for arbitrary data series (rather than for MODEL_SPECS)
+SERIES_PARAMS = {"yearly_seasonality": True, "interval_width": 0.8}
+
+TREND_WINDOW = 120 # number of most recent observations of each series the numpy models are fitted on
+MIN_SEASONAL_OBSERVATIONS = 36 # series with fewer observations are fitted by the numpy backend without seasonality
+
+
+# helper function, converts a date to the number of months since year 0 (so months can be subtracted)
+def to_month_index(date):
+    date = pd.to_datetime(date)
+    return date.year * 12 + date.month - 1
+
+# forecasts yhat, yhat_lower and yhat_upper of a fitted prophet model for all months from the start of its data
+# up to the end month index, returns a table: "start" (month index of the first entry) and the 3 arrays
+def forecast_model(m, end):
+    last_recorded_month = to_month_index(m.history["ds"].max())
+    future = m.make_future_dataframe(periods=end - last_recorded_month, freq='MS')
+    with stage_timer("model_predict"):
+        forecast = m.predict(future)
+    return {
+        "start": np.array(to_month_index(forecast["ds"].iloc[0])),
+        "yhat": forecast["yhat"].to_numpy(),
+        "yhat_lower": forecast["yhat_lower"].to_numpy(),
+        "yhat_upper": forecast["yhat_upper"].to_numpy(),
+    }
+
+
+# forecasting backends of ForecastModels
+# build(models, specs) fits a model for each entry of specs (model name -> data series and parameters) on the
+# data of models (a ForecastModels) and returns their forecast tables (see forecast_model) up to
+# models.get_forecast_end(), it also sets models.refitted and optionally models.fit_times, models.fitted,
+# models.cache_key and models.series_forecasts
+
+
+# prophet models, fitted in parallel and cached on disk since a fit takes seconds
+# when refreshing, only the models whose series changed are refitted, starting from their previous parameters
+class ProphetForecaster():
+    name = "prophet"
+
+    def build(self, models, specs):
+        self.load_or_fit_models(models, specs)
+        return self.build_forecast_table(models, specs)
+
+    # loads the fitted models for the current data and parameters from the cache directory,
+    # models are only refitted (and the cache rewritten) when there is no matching entry
+    def load_or_fit_models(self, models, specs):
+        # prophet is only imported when this backend is used
+        from model_cache import compute_cache_key, load_models, save_models
+        from model_fitting import fit_models, warm_start_params
+
+        models.cache_key = compute_cache_key(models.data_path, specs)
+        with stage_timer("model_cache_load"):
+            fitted = load_models(models.cache_dir, models.cache_key)
+        models.refitted = set(specs) if fitted is None else set()
+        if fitted is None or set(fitted) != set(specs):
+            fitted = {}
+            jobs = {}
+            inits = {}
+            for name, spec in specs.items():
+                if not models.is_series_changed(spec["series"]):
+                    fitted[name] = models.previous.fitted[name]
+                    continue
+                jobs[name] = (spec["params"], models.cpi[spec["series"]])
+                if models.previous is not None:
+                    inits[name] = warm_start_params(models.previous.fitted[name])
+            new_fits, models.fit_times = fit_models(jobs, workers=models.fit_workers, inits=inits)
+            fitted.update(new_fits)
+            models.refitted = set(new_fits)
+            save_models(models.cache_dir, models.cache_key, fitted)
+        models.fitted = fitted
+
+    # precomputes yhat, yhat_lower and yhat_upper of every model for all months from the start of
+    # the data up to the forecast end, predictions then only need to slice these arrays
+    def build_forecast_table(self, models, specs):
+        from model_cache import load_forecasts, save_forecasts
+
+        end = models.get_forecast_end()
+        key = f"{models.cache_key}-{end}"
+        forecasts = load_forecasts(models.cache_dir, key)
+        if forecasts is None or set(forecasts) != set(specs):
+            previous = models.previous
+            forecasts = {}
+            for name in specs:
+                # the previous forecasts of models that were not refitted are still valid
+                if previous is not None and name not in models.refitted and previous.get_forecast_end() == end:
+                    forecasts[name] = previous.forecasts[name]
+                else:
+                    forecasts[name] = forecast_model(models.fitted[name], end)
+            save_forecasts(models.cache_dir, key, forecasts)
+        return forecasts
+
+
+# log-linear trend with monthly seasonality, fitted by least squares on the log of the most recent window
+# observations of each series, with prediction intervals from the residuals
+# only needs numpy, and fits every series of the data (not only those of the specs) in one batched pass,
+# which takes a fraction of a second, so nothing is cached and series never need fitting on demand
+class NumpyForecaster():
+    name = "numpy"
+
+    def __init__(self, window=TREND_WINDOW, series_params=SERIES_PARAMS):
+        self.window = window
+        self.series_params = series_params
+
+    def build(self, models, specs):
+        store = models.store
+        # every series with the default parameters, followed by the series of the specs with their own
+        rows = list(range(len(store.series_names))) + [store.series_index[spec["series"]] for spec in specs.values()]
+        params = [self.series_params] * len(store.series_names) + [spec["params"] for spec in specs.values()]
+
+        start = time.perf_counter()
+        table_start, yhat, yhat_lower, yhat_upper = fit_forecast_matrix(
+            store.months,
+            store.values[rows],
+            models.get_forecast_end(),
+            np.array([p.get("yearly_seasonality", True) for p in params], dtype=bool),
+            np.array([p.get("interval_width", 0.8) for p in params]),
+            self.window,
+        )
+        observe_stage("model_fit", time.perf_counter() - start)
+
+        tables = [
+            {"start": np.array(table_start), "yhat": yhat[i], "yhat_lower": yhat_lower[i], "yhat_upper": yhat_upper[i]}
+            for i in range(len(rows))
+        ]
+        models.series_forecasts = dict(zip(store.series_names, tables))
+        models.refitted = {name for name, spec in specs.items() if models.is_series_changed(spec["series"])}
+        return dict(zip(specs, tables[len(store.series_names):]))
+
+
+# helper function, design matrix of the numpy models for the month indices: intercept, trend (in years
+# since the reference month) and an indicator of each calendar month except january
+def design_matrix(months, reference_month):
+    X = np.zeros((len(months), 13))
+    X[:, 0] = 1
+    X[:, 1] = (months - reference_month) / 12
+    calendar_month = months % 12
+    seasonal = calendar_month > 0
+    X[np.flatnonzero(seasonal), calendar_month[seasonal] + 1] = 1
+    return X
+
+# fits a log-linear trend with monthly seasonality to each row of values (series x month, NaN where there
+# is no data, months gives the month index of each column) on its last window observations, and forecasts
+# every row for all months from the first column up to the end month index
+# yearly_seasonality and interval_width give the parameters of each row
+# returns the month index of the first forecast month and the yhat, yhat_lower and yhat_upper matrices
+def fit_forecast_matrix(months, values, end, yearly_seasonality, interval_width, window=TREND_WINDOW):
+    y = np.log(values.astype(np.float64))
+    observed = ~np.isnan(y)
+    # only the last window observations of each row are fitted
+    remaining = np.cumsum(observed[:, ::-1], axis=1)[:, ::-1]
+    used = observed & (remaining <= window)
+    weights = used.astype(np.float64)
+    y = np.where(used, y, 0.0)
+    num_observations = used.sum(axis=1)
+
+    X = design_matrix(months, months[-1])
+    # parameters of each row that are fitted: no seasonality if it is turned off or there is too little data,
+    # and no indicator for calendar months without observations
+    fitted = np.ones((len(values), X.shape[1]), dtype=bool)
+    fitted[~yearly_seasonality | (num_observations < MIN_SEASONAL_OBSERVATIONS), 2:] = False
+    fitted[:, 2:] &= (weights @ X[:, 2:]) > 0
+
+    # normal equations of every row at once, parameters that are not fitted are pinned to 0
+    both_fitted = fitted[:, :, None] & fitted[:, None, :]
+    XtX = np.einsum("sm,mi,mj->sij", weights, X, X)
+    XtX = np.where(both_fitted, XtX, 0.0) + np.eye(X.shape[1]) * ~fitted[:, None, :]
+    Xty = np.where(fitted, (weights * y) @ X, 0.0)
+    XtX_inv = np.where(both_fitted, np.linalg.inv(XtX), 0.0)
+    beta = np.einsum("sij,sj->si", XtX_inv, Xty)
+
+    residuals = np.where(used, y - beta @ X.T, 0.0)
+    dof = np.maximum(num_observations - fitted.sum(axis=1), 1)
+    sigma = np.sqrt((residuals ** 2).sum(axis=1) / dof)
+
+    forecast_months = np.arange(months[0], end + 1)
+    X_forecast = design_matrix(forecast_months, months[-1])
+    mean = beta @ X_forecast.T
+    # standard error of a new observation: the residual noise plus the uncertainty of the fitted parameters,
+    # which grows as the trend is extrapolated
+    leverage = np.einsum("sgi,gi->sg", np.einsum("gj,sij->sgi", X_forecast, XtX_inv), X_forecast)
+    spread = sigma[:, None] * np.sqrt(1 + leverage)
+    z = np.array([statistics.NormalDist().inv_cdf((1 + w) / 2) for w in interval_width])[:, None]
+    return forecast_months[0], np.exp(mean), np.exp(mean - z * spread), np.exp(mean + z * spread)
+
+
+FORECASTERS = {"prophet": ProphetForecaster, "numpy": NumpyForecaster}
+
+# returns a forecaster by name ("prophet" or "numpy")
+def get_forecaster(name):
+    if name not in FORECASTERS:
+        raise ValueError(f"Unknown forecaster {name}, must be one of {list(FORECASTERS)}")
+    return FORECASTERS[name]()
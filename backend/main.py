@@ -1,25 +1,40 @@
-from typing import Union
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import List, Union
 
-from prediction_engine import PredictionEngine
+import numpy as np
 
-from fastapi import FastAPI
+import shared_modules  # noqa: F401, makes metrics, offload and profiling importable
+from metrics import add_metrics
+from offload import BoundedProcessPool, PoolSaturated, coalesce_key
+from profiling import add_profiling, current_profile
+from response_cache import ResponseCache, compute_etag, etag_matches
+from state_store import StateStore
+
+from fastapi import FastAPI, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+
+# starts the warm-up (see warm_up) with the server, and shuts the pool down with it
+@asynccontextmanager
+async def lifespan(app):
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    yield
+    pool.shutdown()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:3000",
 ]
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# initialize the prediction engine
+# state used for users that have not set their own state
 state = {
   "food": 500,
   "transport": 100,
@@ -30,7 +45,186 @@ state = {
   "invest": 0,
   "take_home": 2500,
 }
-engine = PredictionEngine(**state)
+
+# forecasting backend, set EZBUDGET_FORECASTER to "numpy" for the lightweight models that do not need prophet
+FORECASTER = os.environ.get("EZBUDGET_FORECASTER", "prophet")
+
+# the fitted models, shared by the prediction engines of all users, and the models of the other data series
+# (fitted when first requested), both None until the warm-up has loaded them (see warm_up)
+models = None
+series_models = None
+# the cache of series models (and with it the models, series_models.models) a request is served with, set by
+# cache_responses to the ones its etag is computed from, so a refresh while the request runs does not change them
+request_series_models = contextvars.ContextVar("request_series_models", default=None)
+# state of each user, set EZBUDGET_STATE_DB to a sqlite file to share them between worker processes
+states = StateStore(capacity=10000, db_path=os.environ.get("EZBUDGET_STATE_DB"))
+
+# fitting models of other series is cpu-bound, it runs in worker processes so it does not block the event
+# loop, fits beyond max_pending are turned away with 429 instead of queueing up
+POOL_WORKERS = None # one per cpu
+POOL_MAX_PENDING = None # 4 per worker
+pool = BoundedProcessPool(workers=POOL_WORKERS, max_pending=POOL_MAX_PENDING)
+
+# GET routes whose responses only depend on the models' version, the month, the request and (if True) the
+# user's state, they are sent with an etag, answered with 304 Not Modified when it matches If-None-Match
+# and kept in a server-side cache
+CACHED_ROUTES = {
+    "/predict/predict_exp/": True,
+    "/predict/predict_total_expenditure/": True,
+    "/predict/predict_cumulative_savings/": True,
+    "/predict/savings_dashboard": True,
+    "/predict/long_horizon/": True,
+    "/predict/simulate_cumulative_savings/": True,
+    "/predict/series/": False,
+}
+response_cache = ResponseCache()
+
+# most price paths a simulation may draw, bounds the time and memory of a request
+MAX_PATHS = 1000000
+
+# /admin/* routes are only served when EZBUDGET_ADMIN_TOKEN is set (404 otherwise), and need it in the
+# X-Admin-Token header
+ADMIN_TOKEN = os.environ.get("EZBUDGET_ADMIN_TOKEN")
+# only one refresh of the models runs at a time, held by the thread running it
+refresh_lock = threading.Lock()
+# state of the last refresh (see run_refresh), returned by GET /admin/refresh
+refresh_status = {"status": "idle"}
+
+# what-if scenarios: one row of values per scenario, one column per state field
+class Scenarios(BaseModel):
+    columns: List[str]
+    values: List[List[float]]
+
+# routes that need the models, they get 503 Service Unavailable until the warm-up has loaded them
+MODEL_ROUTES = ("/predict/", "/admin/")
+# routes that do not, although under MODEL_ROUTES
+NO_MODEL_ROUTES = ("/predict/set_state",)
+
+# loading the models is retried this many times, waiting WARMUP_BACKOFF seconds after the first failure and
+# twice as long after each next one, if they all fail /healthz fails so the process gets replaced
+WARMUP_ATTEMPTS = 5
+WARMUP_BACKOFF = 2.0
+
+# state of the warm-up: set when the models are loaded, the error of the last failed attempt, whether every
+# attempt failed, and the time it took
+ready = threading.Event()
+warmup_error = None
+warmup_failed = False
+warmup_seconds = None
+
+# loads the models: imports pandas and the forecasting backend (and prophet with it), then loads the fitted
+# models from the cache or fits them
+def load_models():
+    global models, series_models
+    from forecasters import get_forecaster
+    from prediction_engine import ForecastModels, PredictionEngine
+    from series_cache import SeriesModelCache
+
+    new_models = ForecastModels(forecaster=get_forecaster(FORECASTER))
+    # a first prediction, so the first request does not pay for what is loaded on first use
+    PredictionEngine(**state, models=new_models).predict_cumulative_savings(1)
+    models, series_models = new_models, SeriesModelCache(new_models)
+
+# loads the models with retries (see WARMUP_ATTEMPTS), runs in a background thread started with the server so
+# requests that do not need the models are served right away
+def warm_up():
+    global warmup_error, warmup_failed, warmup_seconds
+    start = time.perf_counter()
+    for attempt in range(WARMUP_ATTEMPTS):
+        try:
+            load_models()
+        except Exception as e:
+            logging.exception("Loading the models failed (attempt %d of %d)", attempt + 1, WARMUP_ATTEMPTS)
+            warmup_error = f"{type(e).__name__}: {e}"
+            if attempt + 1 < WARMUP_ATTEMPTS:
+                time.sleep(WARMUP_BACKOFF * 2**attempt)
+            continue
+        warmup_error = None
+        warmup_seconds = time.perf_counter() - start
+        ready.set()
+        return
+    warmup_failed = True
+
+# returns the cache of series models the request is served with (see request_series_models)
+def get_series_models():
+    return request_series_models.get() or series_models
+
+# returns the models the request is served with
+def get_models():
+    return get_series_models().models
+
+# returns the prediction engine for the state of the user
+def get_engine(user_id):
+    from prediction_engine import PredictionEngine
+
+    user_state = states.get(user_id) or state
+    return PredictionEngine(**user_state, models=get_models())
+
+@app.middleware("http")
+async def cache_responses(request: Request, call_next):
+    path = request.url.path
+    uses_state = next((uses_state for route, uses_state in CACHED_ROUTES.items() if path.startswith(route)), None)
+    # profiled requests skip the cache (lookup and store), so the profile shows the real handler
+    if request.method != "GET" or uses_state is None or current_profile.get() is not None:
+        return await call_next(request)
+
+    # the state is looked up like get_engine does (in the threadpool, it may read the database), the forecasts
+    # are not touched
+    user_state = None
+    if uses_state:
+        user_state = await run_in_threadpool(states.get, request.query_params.get("user_id", "default")) or state
+    current_series_models = series_models
+    current_models = current_series_models.models
+    etag = compute_etag(
+        current_models.version,
+        current_models.get_today_month_index(),
+        user_state,
+        path,
+        sorted(request.query_params.multi_items()),
+    )
+    # clients store the responses but must revalidate them, the state can change at any time
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache" if uses_state else "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        response_cache.count_not_modified()
+        return Response(status_code=304, headers=headers)
+    cached = response_cache.get(etag)
+    if cached is not None:
+        status_code, body, media_type = cached
+        return Response(body, status_code=status_code, headers=headers, media_type=media_type)
+
+    token = request_series_models.set(current_series_models)
+    try:
+        response = await call_next(request)
+    finally:
+        request_series_models.reset(token)
+    if response.status_code != 200:
+        return response
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    response_cache.add(etag, response.status_code, body, response.media_type)
+    return Response(body, status_code=response.status_code, headers={**response.headers, **headers}, media_type=response.media_type)
+
+@app.middleware("http")
+async def require_models(request: Request, call_next):
+    path = request.url.path
+    if not ready.is_set() and path.startswith(MODEL_ROUTES) and not path.startswith(NO_MODEL_ROUTES):
+        error = "Loading the models failed" if warmup_failed else "Models are still loading, please try again later"
+        return JSONResponse({"error": error}, status_code=503, headers={"Retry-After": "5"})
+    return await call_next(request)
+
+# profiles requests that ask for it when EZBUDGET_PROFILE_DIR is set (see profiling.py), added after the other
+# middlewares so it covers them too
+add_profiling(app)
+# latency of each route and of each stage, served at /metrics, added after the middlewares above so it records
+# every response, including the ones they answer themselves (cached, 304 and 503 responses)
+add_metrics(app)
+# added last, so the cors headers are added to every response, also the ones the middlewares above answer
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=origins,
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
 
 
 
@@ -41,6 +235,28 @@ engine = PredictionEngine(**state)
 def read_root():
     return {"Hello": "World"}
 
+@app.get("/healthz")
+def read_health():
+    """
+    Liveness: the server is up and serving requests, also while the models are loading, 503 once loading them
+    has failed for good.
+    """
+    if warmup_failed:
+        return JSONResponse({"status": "error", "error": warmup_error}, status_code=503)
+    return {"status": "ok"}
+
+@app.get("/readyz")
+def read_readiness():
+    """
+    Readiness: the models are loaded and /predict/* can be served, 503 until then.
+    """
+    if warmup_failed:
+        return JSONResponse({"status": "error", "error": warmup_error}, status_code=503)
+    if not ready.is_set():
+        # the error of the last attempt, if loading is being retried
+        return JSONResponse({"status": "loading", "error": warmup_error}, status_code=503)
+    return {"status": "ready", "forecaster": models.forecaster.name, "warmup_seconds": warmup_seconds}
+
 @app.post("/predict/set_state")
 def set_state(
     food: Union[float, None] = 0,
@@ -51,11 +267,12 @@ def set_state(
     housing: Union[float, None] = 0,
     invest: Union[float, None] = 0,
     take_home: Union[float, None] = 0,
+    user_id: str = "default",
 ):
     """
-    Set the state of the prediction engine.
+    Set the state of the prediction engine for a user.
     """
-    state = {
+    user_state = {
         "food": food,
         "transport": transport,
         "use_public_transport": use_public_transport,
@@ -66,53 +283,284 @@ def set_state(
         "take_home": take_home
     }
 
-    engine.set_new_values(**state)
+    states.set(user_id, user_state)
     
     return {"message": "State updated successfully"}
 
 @app.get("/predict/predict_exp/{category}/{num_mths}")
-def read_item(category: str, num_mths: int):
+def read_item(category: str, num_mths: int, user_id: str = "default"):
     """
     Predict the expenditure for a specific category and number of months from now.
     """
-    if category not in state:
+    models = get_models()
+    if category not in ["food", "transport", "utilities", "discretionary"]:
         return {"error": "Invalid category"}
     if num_mths < 1:
         return {"error": "num_mths must be greater than 0"}
+    if num_mths > models.max_horizon:
+        return {"error": f"num_mths must be at most {models.max_horizon}"}
     
-    lower, pred, upper = engine.predict_expenditure(category, num_mths)
+    forecast = get_engine(user_id).predict_expenditure(category, num_mths)
     return {
-        "lower": lower,
-        "pred": pred,
-        "upper": upper
+        "lower": forecast["pred_lower"].tolist(),
+        "pred": forecast["pred"].tolist(),
+        "upper": forecast["pred_upper"].tolist()
     }
 
 @app.get("/predict/predict_total_expenditure/{num_mths}")
-def read_total_expenditure(num_mths: int):
+def read_total_expenditure(num_mths: int, user_id: str = "default"):
     """
     Predict the total expenditure for a specific number of months from now.
     """
+    models = get_models()
     if num_mths < 1:
         return {"error": "num_mths must be greater than 0"}
+    if num_mths > models.max_horizon:
+        return {"error": f"num_mths must be at most {models.max_horizon}"}
     
-    result = engine.predict_total_expenditure(num_mths)
+    result = get_engine(user_id).predict_total_expenditure(num_mths)
     return result
 
 @app.get("/predict/predict_cumulative_savings/{num_mths}")
-def read_cumulative_savings(num_mths: int):
+def read_cumulative_savings(num_mths: int, user_id: str = "default"):
     """
     Predict the cumulative savings for a specific number of months from now.
     """
+    models = get_models()
     if num_mths < 1:
         return {"error": "num_mths must be greater than 0"}
+    if num_mths > models.max_horizon:
+        return {"error": f"num_mths must be at most {models.max_horizon}"}
     
-    lower, pred, upper = engine.predict_cumulative_savings(num_mths)
+    lower, pred, upper = get_engine(user_id).predict_cumulative_savings(num_mths)
+    return {
+        "lower": lower.tolist(),
+        "pred": pred.tolist(),
+        "upper": upper.tolist()
+    }
+
+@app.get("/predict/savings_dashboard")
+def read_savings_dashboard(horizons: List[int] = Query([1, 6]), user_id: str = "default"):
+    """
+    Predict everything the savings page shows in one call: the expenditure of each category and the total
+    expenditure at each horizon (number of months from now), and the cumulative savings up to the furthest one.
+    """
+    models = get_models()
+    if not horizons:
+        return {"error": "horizons must not be empty"}
+    if min(horizons) < 1:
+        return {"error": "horizons must be greater than 0"}
+    if max(horizons) > models.max_horizon:
+        return {"error": f"horizons must be at most {models.max_horizon}"}
+
+    dashboard = get_engine(user_id).predict_dashboard(horizons)
+    # columnar: each array has one value per horizon (per month for cumulative_savings)
+    return {"horizons": horizons} | {
+        name: {key: values.tolist() for key, values in columns.items()} for name, columns in dashboard.items()
+    }
+
+@app.get("/predict/long_horizon/{num_mths}")
+def read_long_horizon(num_mths: int, granularity: str = "yearly", user_id: str = "default"):
+    """
+    Project the expenditure of each category and the cumulative savings over the next num_mths months (up to
+    decades, e.g. for retirement planning) at the end of each month, quarter or year.
+    """
+    from prediction_engine import GRANULARITIES, MAX_LONG_HORIZON
+
+    if granularity not in GRANULARITIES:
+        return {"error": f"granularity must be one of {list(GRANULARITIES)}"}
+    if num_mths < 1:
+        return {"error": "num_mths must be greater than 0"}
+    if num_mths > MAX_LONG_HORIZON:
+        return {"error": f"num_mths must be at most {MAX_LONG_HORIZON}"}
+    if num_mths % GRANULARITIES[granularity] != 0:
+        return {"error": f"num_mths must be a multiple of {GRANULARITIES[granularity]} for {granularity} granularity"}
+
+    projection = get_engine(user_id).predict_long_horizon(num_mths, granularity)
+    # columnar: each array has one value per period
+    return {"granularity": granularity, "months": projection["months"].tolist()} | {
+        name: {key: values.tolist() for key, values in columns.items()}
+        for name, columns in projection.items() if name != "months"
+    }
+
+@app.get("/predict/simulate_cumulative_savings/{num_mths}")
+def read_simulated_cumulative_savings(num_mths: int, num_paths: Union[int, None] = None, seed: int = 0, user_id: str = "default"):
+    """
+    Simulate the cumulative savings for each of the next num_mths months over num_paths price paths with
+    correlated price shocks, returns their percentiles and the probability that they are negative in each month.
+    """
+    from prediction_engine import NUM_PATHS
+
+    models = get_models()
+    if num_paths is None:
+        num_paths = NUM_PATHS
+    if num_mths < 1:
+        return {"error": "num_mths must be greater than 0"}
+    if num_mths > models.max_horizon:
+        return {"error": f"num_mths must be at most {models.max_horizon}"}
+    if num_paths < 2 or num_paths > MAX_PATHS:
+        return {"error": f"num_paths must be between 2 and {MAX_PATHS}"}
+
+    percentiles, probability_negative = get_engine(user_id).simulate_cumulative_savings(num_mths, num_paths=num_paths, seed=seed)
     return {
-        "lower": lower,
-        "pred": pred,
-        "upper": upper
+        "percentiles": {str(p): values.tolist() for p, values in percentiles.items()},
+        "prob_negative": probability_negative.tolist()
     }
 
+@app.post("/predict/predict_cumulative_savings_batch/{num_mths}")
+def read_cumulative_savings_batch(num_mths: int, scenarios: Scenarios, user_id: str = "default"):
+    """
+    Predict the cumulative savings for a specific number of months from now for many what-if scenarios at once.
+    Fields that are not among the columns keep the values of the user's state.
+    """
+    models = get_models()
+    if num_mths < 1:
+        return {"error": "num_mths must be greater than 0"}
+    if num_mths > models.max_horizon:
+        return {"error": f"num_mths must be at most {models.max_horizon}"}
+    invalid = [column for column in scenarios.columns if column not in state]
+    if invalid:
+        return {"error": f"Invalid columns: {invalid}"}
+    if any(len(row) != len(scenarios.columns) for row in scenarios.values):
+        return {"error": "Every scenario must have a value for each column"}
+    if not scenarios.values:
+        return {"lower": [], "pred": [], "upper": []}
+
+    values = np.array(scenarios.values, dtype=float)
+    columns = {column: values[:, i] for i, column in enumerate(scenarios.columns)}
+    lower, pred, upper = get_engine(user_id).predict_cumulative_savings_batch(columns, num_mths)
+    # the result is plain lists already, skip fastapi's (slow for large results) recursive encoding
+    return JSONResponse({
+        "lower": lower.tolist(),
+        "pred": pred.tolist(),
+        "upper": upper.tolist()
+    })
+
+
+
+
+
+@app.get("/predict/cache")
+def read_response_cache():
+    """
+    Statistics of the server-side cache of /predict/* responses.
+    """
+    return response_cache.stats()
+
+@app.get("/predict/series")
+def read_series_names():
+    """
+    List the data series that can be predicted, and the state of the cache of their models.
+    """
+    cache = get_series_models()
+    return {
+        "series": cache.models.series_names,
+        "forecaster": cache.models.forecaster.name,
+        "cache": cache.stats(),
+        "pool": pool.stats()
+    }
+
+@app.get("/predict/series/{series_name}/{num_mths}")
+async def read_series(series_name: str, num_mths: int, amount: float = 100):
+    """
+    Predict the cost of something in a data series that costs amount today, for each of the next num_mths months.
+    The model of the series is fitted the first time it is requested.
+    """
+    from series_cache import fit_series
+
+    cache = get_series_models()
+    models = cache.models
+    if series_name not in models.series_names:
+        return {"error": "Invalid series"}
+    if num_mths < 1:
+        return {"error": "num_mths must be greater than 0"}
+    if num_mths > models.max_horizon:
+        return {"error": f"num_mths must be at most {models.max_horizon}"}
+
+    table = cache.lookup(series_name)
+    if table is None:
+        # concurrent requests for the same series share one fit
+        try:
+            table = await pool.run(
+                coalesce_key("series", series_name, cache.models.cache_key),
+                fit_series,
+                *cache.get_fit_args(series_name)
+            )
+        except PoolSaturated:
+            return JSONResponse({"error": "Server is busy, please try again later"}, status_code=429, headers={"Retry-After": "1"})
+        cache.add(series_name, table)
+
+    ratios = models.get_price_ratios(table, num_mths)
+    return {
+        "lower": (amount * ratios["pred_lower"]).tolist(),
+        "pred": (amount * ratios["pred"]).tolist(),
+        "upper": (amount * ratios["pred_upper"]).tolist()
+    }
+
+
+
+
+
+# returns the error response of an /admin/* request, or None if it has the admin token
+def check_admin_token(x_admin_token):
+    if ADMIN_TOKEN is None:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    if x_admin_token != ADMIN_TOKEN:
+        return JSONResponse({"error": "Invalid admin token"}, status_code=403)
+    return None
+
+# refreshes the models (see refresh_models) in a background thread, which releases refresh_lock when done
+def run_refresh():
+    from series_cache import SeriesModelCache
+
+    global models, series_models, refresh_status
+    start = time.perf_counter()
+    try:
+        new_models = models.refresh()
+        new_series_models = SeriesModelCache(new_models, max_bytes=series_models.max_bytes, max_entries=series_models.max_entries)
+        models, series_models = new_models, new_series_models
+        refresh_status = {
+            "status": "done",
+            "refitted": sorted(new_models.refitted),
+            "fit_times": new_models.fit_times,
+            "last_month": f"{new_models.store.months[-1] // 12}-{new_models.store.months[-1] % 12 + 1:02d}",
+            "seconds": time.perf_counter() - start,
+        }
+    except Exception as e:
+        logging.exception("Refreshing the models failed")
+        refresh_status = {"status": "error", "error": f"{type(e).__name__}: {e}"}
+    finally:
+        refresh_lock.release()
+
+@app.post("/admin/refresh", status_code=202)
+def refresh_models(x_admin_token: Union[str, None] = Header(default=None)):
+    """
+    Start reloading the cpi data, refitting the models of series with new observations and swapping them in, in the
+    background, GET /admin/refresh returns how it went. Requests that are already running finish with the models
+    they started with.
+    """
+    global refresh_status
+    error = check_admin_token(x_admin_token)
+    if error is not None:
+        return error
+    if not refresh_lock.acquire(blocking=False):
+        return JSONResponse({"error": "A refresh is already running"}, status_code=409)
+
+    refresh_status = {"status": "running"}
+    threading.Thread(target=run_refresh, name="refresh", daemon=True).start()
+    return {"status": "running", "message": "Refreshing the models"}
+
+@app.get("/admin/refresh")
+def read_refresh_status(x_admin_token: Union[str, None] = Header(default=None)):
+    """
+    State of the last refresh of the models: idle (none yet), running, done (with the refitted models and the time
+    spent fitting each one) or error.
+    """
+    error = check_admin_token(x_admin_token)
+    if error is not None:
+        return error
+    return refresh_status
+
 
 
 
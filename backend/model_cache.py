@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import prophet
+from prophet.serialize import model_to_json, model_from_json
+
+
+# computes a key that identifies a set of fitted models: the hash of the data file, the fit
+# parameters of every model and the prophet version (serialized models are not portable across versions)
+def compute_cache_key(data_path, model_specs):
+    h = hashlib.sha256()
+    with open(data_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    h.update(json.dumps(model_specs, sort_keys=True).encode())
+    h.update(prophet.__version__.encode())
+    return h.hexdigest()[:16]
+
+
+def _models_path(cache_dir, key):
+    return os.path.join(cache_dir, f"models-{key}.json")
+
+
+def _forecasts_path(cache_dir, key):
+    return os.path.join(cache_dir, f"forecasts-{key}.npz")
+
+
+# removes every file in cache_dir with the given prefix except the one at keep_path
+# (files still being written by other workers are left alone)
+def _prune(cache_dir, prefix, keep_path):
+    for filename in os.listdir(cache_dir):
+        if filename.startswith(prefix) and not filename.endswith(".tmp") and filename != os.path.basename(keep_path):
+            try:
+                os.remove(os.path.join(cache_dir, filename))
+            except FileNotFoundError:
+                pass  # already removed by another worker
+
+
+# loads the fitted models stored under key, returns None if there are none (or they are unreadable)
+def load_models(cache_dir, key):
+    path = _models_path(cache_dir, key)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            serialized = json.load(f)
+        return {name: model_from_json(s) for name, s in serialized.items()}
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+# stores the fitted models under key, the file is written to a temporary path first and then
+# moved into place, so concurrently starting workers never see a half-written file
+def save_models(cache_dir, key, models):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _models_path(cache_dir, key)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({name: model_to_json(m) for name, m in models.items()}, f)
+    os.replace(tmp_path, path)
+    # models fitted on older data or with other parameters will not be used again
+    _prune(cache_dir, "models-", path)
+
+
+# loads the forecast table stored under key as a dict of model name -> dict of arrays,
+# returns None if there is none
+def load_forecasts(cache_dir, key):
+    path = _forecasts_path(cache_dir, key)
+    if not os.path.exists(path):
+        return None
+    try:
+        forecasts = {}
+        with np.load(path) as data:
+            for entry in data.files:
+                name, column = entry.split("/")
+                forecasts.setdefault(name, {})[column] = data[entry]
+        return forecasts
+    except (OSError, ValueError):
+        return None
+
+
+# stores the forecast table under key, written atomically like the models
+def save_forecasts(cache_dir, key, forecasts):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _forecasts_path(cache_dir, key)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **{f"{name}/{column}": arr for name, table in forecasts.items() for column, arr in table.items()})
+    os.replace(tmp_path, path)
+    _prune(cache_dir, "forecasts-", path)
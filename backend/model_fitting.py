@@ -0,0 +1,76 @@
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from prophet import Prophet
+from prophet.serialize import model_to_json, model_from_json
+
+import shared_modules  # noqa: F401, makes metrics, offload and profiling importable
+from metrics import observe_stage
+
+logger = logging.getLogger(__name__)
+
+
+# returns the fitted parameters of a model in the form prophet's fit takes as init, so that a model
+# refitted on slightly more data starts from where the previous fit ended
+def warm_start_params(m):
+    params = {}
+    for name in ["k", "m", "sigma_obs"]:
+        params[name] = m.params[name][0][0]
+    for name in ["delta", "beta"]:
+        params[name] = m.params[name][0]
+    return params
+
+
+# fits one prophet model, starting the optimization from init if given
+def _fit(params, data, init=None):
+    m = Prophet(**params)
+    if init is not None:
+        m.fit(data, init=init)
+    else:
+        m.fit(data)
+    return m
+
+
+# fits one prophet model in a worker process, the fitted model is sent back serialized
+def _fit_model(name, params, data, init=None):
+    start = time.perf_counter()
+    m = _fit(params, data, init)
+    return name, model_to_json(m), time.perf_counter() - start
+
+
+# fits a prophet model for each entry of jobs (model name -> (prophet parameters, data to fit)),
+# the models are independent so they are fitted concurrently in up to workers processes
+# (defaults to the number of cpus), inits optionally gives the initial parameters of some of the models
+# (see warm_start_params), returns the fitted models and the time spent fitting each one
+def fit_models(jobs, workers=None, inits=None):
+    if not jobs:
+        return {}, {}
+    inits = inits or {}
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(jobs)))
+
+    models = {}
+    fit_times = {}
+    start = time.perf_counter()
+    if workers == 1:
+        # not worth starting processes for
+        for name, (params, data) in jobs.items():
+            fit_start = time.perf_counter()
+            models[name] = _fit(params, data, inits.get(name))
+            fit_times[name] = time.perf_counter() - fit_start
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_fit_model, name, params, data, inits.get(name)) for name, (params, data) in jobs.items()]
+            for future in futures:
+                name, serialized, fit_time = future.result()
+                models[name] = model_from_json(serialized)
+                fit_times[name] = fit_time
+
+    for name, fit_time in fit_times.items():
+        observe_stage("model_fit", fit_time)
+        logger.info("fitted %s in %.2fs", name, fit_time)
+    logger.info("fitted %d models with %d workers in %.2fs", len(models), workers, time.perf_counter() - start)
+    return models, fit_times
@@ -1,84 +1,187 @@
+import hashlib
+import json
+
+import numpy as np
 import pandas as pd
-from prophet import Prophet
 
-class PredictionEngine():
-    interval_width = 0.8 # make predictions with 80% confidence interval
-    current_expenditure = {}
-    m_food = Prophet(yearly_seasonality=True, interval_width=interval_width)
-    m_util = Prophet(yearly_seasonality=True, interval_width=0.6)
-    m_tran = Prophet(yearly_seasonality=False, interval_width=0.6) # yearly seasonality is not relevant for transport
-    m_petr = Prophet(yearly_seasonality=True, interval_width=0.6)
-    m_recr = Prophet(yearly_seasonality=True, interval_width=0.6)
-
-    def __init__(self, food, transport, use_public_transport, utilities, discretionary, housing, invest, take_home):
-        self.current_expenditure["food"] = food
-        self.current_expenditure["transport"] = transport
-        self.current_expenditure["utilities"] = utilities
-        self.current_expenditure["discretionary"] = discretionary
-        self.current_expenditure["housing"] = housing
-        self.current_expenditure["invest"] = invest
-        self.use_public_transport = use_public_transport
-        self.take_home = take_home
+import shared_modules  # noqa: F401, makes metrics, offload and profiling importable
+from cpi_store import load_store
+from forecasters import ProphetForecaster
+from metrics import stage_timer
+
+DATA_PATH = "data/cpi_data.csv"
+MODEL_CACHE_DIR = "model_cache"
+MAX_HORIZON = 120 # furthest month from now (in months) that can be predicted
+MAX_LONG_HORIZON = 600 # furthest month from now that long-horizon projections (beyond the forecast tables) reach
+GRANULARITIES = {"monthly": 1, "quarterly": 3, "yearly": 12} # months per period of long-horizon projections
+FIT_WORKERS = None # number of processes fitting models concurrently, None for one per cpu
+SHOCK_WINDOW = 120 # number of most recent month-over-month price changes the simulated price shocks are estimated from
+NUM_PATHS = 100000 # number of price paths simulated by default
+PERCENTILES = [5, 25, 50, 75, 95] # percentiles of the simulated savings returned by default
+BLOCK_SIZE = 2**22 # number of random draws generated at a time by simulations, bounds their memory use
+CATEGORIES = ["food", "transport", "utilities", "discretionary"] # categories of expenditure affected by prices
+
+# models fitted on the cpi data: model name -> data series in cpi_data.csv and prophet parameters
+# (the numpy forecaster only uses yearly_seasonality and interval_width)
+# changing any of these invalidates the cached models
+MODEL_SPECS = {
+    "m_food": {"series": "Food", "params": {"yearly_seasonality": True, "interval_width": 0.8}}, # make predictions with 80% confidence interval
+    "m_util": {"series": "Utilities & Other Fuels", "params": {"yearly_seasonality": True, "interval_width": 0.6}},
+    "m_tran": {"series": "Land Transport Services", "params": {"yearly_seasonality": False, "interval_width": 0.6}}, # yearly seasonality is not relevant for transport
+    "m_petr": {"series": "Petrol", "params": {"yearly_seasonality": True, "interval_width": 0.6}},
+    "m_recr": {"series": "Recreation, Sport & Culture", "params": {"yearly_seasonality": True, "interval_width": 0.6}},
+}
+
+# the fitted models and their forecast tables, these do not depend on any user's expenditure
+# so one instance is shared by all prediction engines
+# instances are not modified once built, updated data gives a new instance (see refresh)
+class ForecastModels():
+    def __init__(self, cache_dir=MODEL_CACHE_DIR, max_horizon=MAX_HORIZON, fit_workers=FIT_WORKERS, previous=None, forecaster=None):
+        self.cache_dir = cache_dir
+        self.max_horizon = max_horizon
+        self.fit_workers = fit_workers
+        # backend fitting and forecasting the models (see forecasters.py), prophet by default
+        self.forecaster = forecaster if forecaster is not None else ProphetForecaster()
+        self.cache_key = None # key of the cached models, if the forecaster caches them
+        self.fitted = {} # model name -> fitted model, if the forecaster keeps them
+        self.refitted = set() # names of the models fitted on new data rather than reused
+        self.fit_times = {} # seconds spent fitting each model, empty if they were loaded from the cache
+        self.series_forecasts = {} # forecast table of every data series, if the forecaster forecasts them all at once
+        # models built from older data (if refreshing), their fits are reused for series without new data
+        self.previous = previous
         # read and process external data
         self.initialise_data()
-        # fit models
-        self.m_food.fit(self.cpi_food)
-        self.m_util.fit(self.cpi_utilities)
-        self.m_tran.fit(self.cpi_public_transport)
-        self.m_petr.fit(self.cpi_petrol)
-        self.m_recr.fit(self.cpi_recreation)        
+        # fit the models (or load them from the cache) and forecast each one once up to max_horizon months from
+        # now (plus a year of slack so a long running server stays covered), predictions then only need to slice
+        # these tables, each model's table is a dict: "start" (month index of the first entry) and the arrays
+        # yhat, yhat_lower and yhat_upper
+        self.forecasts = self.forecaster.build(self, MODEL_SPECS)
+        self.previous = None
+        # covariance of the monthly price shocks of the models, for simulations
+        self.build_shock_covariance()
+        # identifies what the forecasts are computed from, so responses derived from them can be cached
+        self.version = self.compute_version()
 
-    def initialise_data(self):
-        # define helper functions
-        mth2num = {
-            "Jan": "01",
-            "Feb": "02",
-            "Mar": "03",
-            "Apr": "04",
-            "May": "05",
-            "Jun": "06",
-            "Jul": "07",
-            "Aug": "08",
-            "Sep": "09",
-            "Oct": "10",
-            "Nov": "11",
-            "Dec": "12"
+    # builds models for the current cpi data, only refitting the models whose series has new (or changed)
+    # observations (if the forecaster supports it), returns the new ForecastModels
+    # this instance is left as is, so requests still using it are not affected
+    def refresh(self):
+        return ForecastModels(self.cache_dir, self.max_horizon, self.fit_workers, previous=self, forecaster=self.forecaster)
+
+    # helper function, checks if the data of a series differs from the data the previous models were built from
+    def is_series_changed(self, series_name):
+        if self.previous is None or series_name not in self.previous.series_names:
+            return True
+        months, values = self.store.get(series_name)
+        previous_months, previous_values = self.previous.store.get(series_name)
+        return not (np.array_equal(months, previous_months) and np.array_equal(values, previous_values))
+
+    # helper function, hash of the cpi data, the forecaster, the model specs and the horizon, models with the
+    # same version give the same forecasts
+    def compute_version(self):
+        key = {
+            "data": self.store.source_hash,
+            "forecaster": self.forecaster.name,
+            "cache_key": self.cache_key,
+            "specs": MODEL_SPECS,
+            "max_horizon": self.max_horizon,
         }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+    # estimates the covariance of the month-over-month changes in the log price of the series of every model over
+    # the last SHOCK_WINDOW months, after removing the average change of each calendar month (the seasonality,
+    # which the forecasts already follow), so simulations can draw price shocks that move together like the real ones
+    def build_shock_covariance(self):
+        rows = [self.store.series_index[spec["series"]] for spec in MODEL_SPECS.values()]
+        changes = np.diff(np.log(self.store.values[rows].astype(np.float64)), axis=1)[:, -SHOCK_WINDOW:]
+        calendar_months = self.store.months[-changes.shape[1]:] % 12
+        for calendar_month in range(12):
+            columns = calendar_months == calendar_month
+            changes[:, columns] -= np.nanmean(changes[:, columns], axis=1, keepdims=True)
+        self.shock_covariance = np.cov(changes[:, ~np.isnan(changes).any(axis=0)])
+        self.shock_index = {name: i for i, name in enumerate(MODEL_SPECS)}
 
-        def rename_month(x):
-            if x == "Data Series":
-                return x
-            year, mth = x.strip().split(" ")
-            return f"{year}-{mth2num[mth]}-01"
-        
-        # read data
-        df = pd.read_csv("data/cpi_data.csv")
-        df["Data Series"] = df["Data Series"].str.strip()
-        df = df.rename(mapper=rename_month, axis='columns')
-        df = df.replace(to_replace="na", value=None)
-
-        def get_ds(series_name):
-            return df[df["Data Series"] == series_name].reset_index(drop=True) \
-                .drop(columns=["Data Series"]) \
-                .T.reset_index().rename(columns={"index": "ds", 0: "y"}) \
-                .dropna()
-
-        self.cpi_food = get_ds("Food")
-        self.cpi_utilities = get_ds("Utilities & Other Fuels")
-        self.cpi_recreation = get_ds("Recreation, Sport & Culture")
+    # returns the covariance of the monthly price shocks of the models
+    def get_shock_covariance(self, model_names):
+        rows = [self.shock_index[name] for name in model_names]
+        return self.shock_covariance[np.ix_(rows, rows)]
+
+    # helper function, month index up to which forecast tables are computed
+    def get_forecast_end(self):
+        return self.get_today_month_index() + self.max_horizon + 12
+
+    # returns the price of each of the next num_mths months relative to the price of the current month
+    # according to a forecast table, with its lower and upper bounds (as a dict of arrays)
+    def get_price_ratios(self, table, num_mths):
+        if num_mths > self.max_horizon:
+            raise ValueError(f"num_mths must be at most {self.max_horizon}")
+        with stage_timer("postprocess"):
+            # rows of the current month and of the following num_mths months
+            today = self.get_today_month_index() - int(table["start"])
+            window = slice(today + 1, today + 1 + num_mths)
+
+            cpi_base = table["yhat"][today]
+            return {
+                "pred": table["yhat"][window] / cpi_base,
+                "pred_lower": table["yhat_lower"][window] / cpi_base,
+                "pred_upper": table["yhat_upper"][window] / cpi_base,
+            }
+
+    # returns the price ratios of get_price_ratios aggregated over periods of step months (1, 3 or 12) for the next
+    # num_mths months (a multiple of step), which may go past max_horizon: the ratio at the end of each period
+    # ("pred", "pred_lower", "pred_upper") and the sum of the ratios of its months ("pred_sum", ...)
+    # past the whole years of the forecast table, each year repeats the last forecasted year (so the seasonality
+    # is kept) compounded by the growth of its geometric mean over the year before, computed separately for
+    # the prediction and its bounds so the interval keeps widening, the cost does not depend on num_mths
+    def get_period_price_ratios(self, table, num_mths, step):
+        if 12 % step != 0 or num_mths % step != 0:
+            raise ValueError("step must divide 12 and num_mths must be a multiple of it")
+        if num_mths > MAX_LONG_HORIZON:
+            raise ValueError(f"num_mths must be at most {MAX_LONG_HORIZON}")
+        table_months = self.max_horizon - self.max_horizon % 12
+        ratios = self.get_price_ratios(table, min(num_mths, table_months))
+        with stage_timer("postprocess"):
+            periods = {}
+            for bound, values in ratios.items():
+                ends = values[step - 1::step]
+                sums = values.reshape(-1, step).sum(axis=1)
+                if num_mths > table_months:
+                    last_year, previous_year = values[-12:], values[-24:-12]
+                    growth = np.exp(np.log(last_year).mean() - np.log(previous_year).mean())
+                    # growth compounded over each extrapolated year
+                    num_periods = (num_mths - table_months) // step
+                    compounded = growth ** np.arange(1, -(-num_periods * step // 12) + 1)
+                    ends = np.concatenate([ends, np.outer(compounded, last_year[step - 1::step]).ravel()[:num_periods]])
+                    sums = np.concatenate([sums, np.outer(compounded, last_year.reshape(-1, step).sum(axis=1)).ravel()[:num_periods]])
+                periods[bound] = ends
+                periods[f"{bound}_sum"] = sums
+            return periods
+
+    def initialise_data(self):
+        # open the columnar store of the cpi data (converted from the csv when it changes)
+        self.data_path = DATA_PATH
+        with stage_timer("csv_load"):
+            self.store = load_store(self.data_path)
+        self.series_names = self.store.series_names
+
+        self.cpi = {spec["series"]: self.get_series(spec["series"]) for spec in MODEL_SPECS.values()}
+        self.cpi_food = self.cpi["Food"]
+        self.cpi_utilities = self.cpi["Utilities & Other Fuels"]
+        self.cpi_recreation = self.cpi["Recreation, Sport & Culture"]
         # maybe need to handle transport separately because it may not follow the cpi exactly
         # (some ppl take public transport, some ppl take a lot of private hire, some ppl drive, soooo ??)
-        self.cpi_petrol = get_ds("Petrol")
-        self.cpi_public_transport = get_ds("Land Transport Services")
+        self.cpi_petrol = self.cpi["Petrol"]
+        self.cpi_public_transport = self.cpi["Land Transport Services"]
+
+    # returns the observations of a data series in cpi_data.csv as a dataframe with columns ds and y
+    def get_series(self, series_name):
+        return self.store.get_frame(series_name)
 
-    # helper function, computes the gap in months between today and the date given
-    def calculate_gap_in_months(self, date_str):
-        year, month, day = date_str.split("-")
+    # helper function, computes today's month index
+    def get_today_month_index(self):
         today_year, today_month = self.get_today_month_year()
-        # compute gap in months
-        gap = (today_year - int(year)) * 12 + abs(int(month) - today_month)
-        return gap
-    
+        return today_year * 12 + today_month - 1
+
     # helper function, computes today's year and month
     def get_today_month_year(self):
         today = pd.to_datetime("today")
@@ -86,86 +189,249 @@ class PredictionEngine():
         today_month = today.month
         return today_year, today_month
 
-    # takes in 2 input: category and number of months from now, returns: probability and prediction of price
-    def predict_expenditure(self, category, num_mths):
+
+# predicts the expenditure and savings of one user, engines are cheap to create since
+# the fitted models are shared
+class PredictionEngine():
+    def __init__(self, food, transport, use_public_transport, utilities, discretionary, housing, invest, take_home, models=None, forecaster=None):
+        self.current_expenditure = {}
+        self.set_new_values(food, transport, use_public_transport, utilities, discretionary, housing, invest, take_home)
+        # the shared models, or models built with the forecaster (see forecasters.py)
+        self.models = models if models is not None else ForecastModels(forecaster=forecaster)
+        self.max_horizon = self.models.max_horizon
+
+    # helper function, returns the name of the model used to predict the category
+    def get_model_name(self, category):
         match category:
             case "food":
-                m = self.m_food
-                last_recorded_month = self.cpi_food["ds"].iloc[0]
+                return "m_food"
             case "transport":
-                m = self.m_tran if self.use_public_transport else self.m_petr
-                last_recorded_month = self.cpi_public_transport["ds"].iloc[0] if self.use_public_transport else cpi_petrol["ds"].iloc[0]
+                return "m_tran" if self.use_public_transport else "m_petr"
             case "utilities":
-                m = self.m_util
-                last_recorded_month = self.cpi_utilities["ds"].iloc[0]
+                return "m_util"
             case "discretionary":
-                m = self.m_recr
-                last_recorded_month = self.cpi_recreation["ds"].iloc[0]
-        # compute how much to add to the last recorded month, to get prediction for the nth month
-        gap = self.calculate_gap_in_months(last_recorded_month)
-        num_mths += gap
-        
-        future = m.make_future_dataframe(periods=num_mths, freq='MS')
-        forecast = m.predict(future)
-
-        # compute change in price for each month compared to the current month
-        today_year, today_month = self.get_today_month_year()
-        today = f"{today_year}-{str(today_month).zfill(2)}-01"
-        cpi_base = forecast["yhat"].loc[forecast["ds"] == today].values[0]
-        forecast["cpi_change"] = forecast["yhat"] - cpi_base
-        forecast["cpi_lower"] = forecast["yhat_lower"] - cpi_base
-        forecast["cpi_upper"] = forecast["yhat_upper"] - cpi_base
-        # compute the predicted expenditure for each month
-        forecast["pred"] = self.current_expenditure[category] + (forecast["cpi_change"] / cpi_base) * self.current_expenditure[category]
-        forecast["pred_lower"] = self.current_expenditure[category] + (forecast["cpi_lower"] / cpi_base) * self.current_expenditure[category]
-        forecast["pred_upper"] = self.current_expenditure[category] + (forecast["cpi_upper"] / cpi_base) * self.current_expenditure[category]
-
-        # return the predicted price for the next num_mths months
-        return forecast.iloc[-(num_mths - gap):].reset_index(drop=True)
-    
+                return "m_recr"
+        raise ValueError(f"No model for category {category}")
+
+    # helper function, returns the price of each of the next num_mths months relative to the price of the
+    # current month as predicted by the model, with its lower and upper bounds (as a dict of arrays)
+    def get_price_ratios(self, model_name, num_mths):
+        return self.models.get_price_ratios(self.models.forecasts[model_name], num_mths)
+
+    # takes in 2 input: category and number of months from now, returns: prediction of the expenditure with
+    # its lower and upper bounds for each of the next num_mths months (as a dict of arrays)
+    def predict_expenditure(self, category, num_mths):
+        ratios = self.get_price_ratios(self.get_model_name(category), num_mths)
+        # the expenditure scales with the change in price compared to the current month
+        current = self.current_expenditure[category]
+        return {
+            "pred": current * ratios["pred"],
+            "pred_lower": current * ratios["pred_lower"],
+            "pred_upper": current * ratios["pred_upper"],
+        }
+
+    # predicts the expenditure of every category affected by prices for each of the next num_mths months,
+    # returns category -> the prediction of predict_expenditure
+    def predict_all_expenditure(self, num_mths):
+        return {category: self.predict_expenditure(category, num_mths) for category in CATEGORIES}
+
     # predict total expenditure for a specific month, num_mths from now
     def predict_total_expenditure(self, num_mths):
         # compute for each category the predicted expenditure for the next num_mths months
         pred = {}
-        for category in ["food", "transport", "utilities", "discretionary"]:
-            pred[category] = self.predict_expenditure(category, num_mths)["pred"].iloc[-1]
+        for category, category_pred in self.predict_all_expenditure(num_mths).items():
+            pred[category] = float(category_pred["pred"][-1])
         pred["housing"] = self.current_expenditure["housing"]
         pred["invest"] = self.current_expenditure["invest"]
         # output
         return pred
 
+    # helper function, total predicted expenditure (including the fixed expenditures, not affected by prices)
+    # in each month from the predictions of predict_all_expenditure, with its lower and upper bounds
+    def get_total_expenditure(self, preds):
+        fixed = self.current_expenditure["housing"] + self.current_expenditure["invest"]
+        return {bound: sum(pred[bound] for pred in preds.values()) + fixed for bound in ["pred", "pred_lower", "pred_upper"]}
+
+    # helper function, cumulative savings in each month from the total expenditure of get_total_expenditure,
+    # returns the lower bound, prediction and upper bound
+    def get_cumulative_savings(self, total):
+        # compute the savings for each month
+        savings = self.take_home - total["pred"]
+        savings_upper = self.take_home - total["pred_lower"] # upper bound of savings = monthly income - lower bound of expenditure
+        savings_lower = self.take_home - total["pred_upper"] # lower bound of savings = monthly income - upper bound of expenditure
+
+        # compute the cumulative savings in total
+        return savings_lower.cumsum(), savings.cumsum(), savings_upper.cumsum()
+
     # predicts cumulative savings in num_mths months
     def predict_cumulative_savings(self, num_mths):
-        # compute the predicted expenditure for each category
-        food_pred = self.predict_expenditure("food", num_mths)
-        transport_pred = self.predict_expenditure("transport", num_mths)
-        utilities_pred = self.predict_expenditure("utilities", num_mths)
-        discretionary_pred = self.predict_expenditure("discretionary", num_mths)
+        # return cumulative savings for the next num_mths
+        return self.get_cumulative_savings(self.get_total_expenditure(self.predict_all_expenditure(num_mths)))
 
-        # compute fixed expenditures, not affected by prices
+    # predicts everything the savings dashboard shows in one pass: the expenditure of every category is predicted
+    # once up to the furthest of the horizons (numbers of months from now), returns
+    # - expenditure: category (including housing and invest) -> predicted expenditure at each horizon
+    # - expenditure_lower, expenditure_upper: its bounds, for the categories affected by prices
+    # - total_expenditure: the lower, pred and upper total expenditure at each horizon
+    # - cumulative_savings: the lower, pred and upper cumulative savings in each month up to the furthest horizon
+    # all values are arrays
+    def predict_dashboard(self, horizons):
+        num_mths = max(horizons)
+        at_horizons = np.asarray(horizons) - 1
+        preds = self.predict_all_expenditure(num_mths)
+        total = self.get_total_expenditure(preds)
+
+        expenditure = {category: pred["pred"][at_horizons] for category, pred in preds.items()}
+        for category in ["housing", "invest"]:
+            expenditure[category] = np.full(len(horizons), float(self.current_expenditure[category]))
+        lower, savings, upper = self.get_cumulative_savings(total)
+        return {
+            "expenditure": expenditure,
+            "expenditure_lower": {category: pred["pred_lower"][at_horizons] for category, pred in preds.items()},
+            "expenditure_upper": {category: pred["pred_upper"][at_horizons] for category, pred in preds.items()},
+            "total_expenditure": {
+                "lower": total["pred_lower"][at_horizons],
+                "pred": total["pred"][at_horizons],
+                "upper": total["pred_upper"][at_horizons],
+            },
+            "cumulative_savings": {"lower": lower, "pred": savings, "upper": upper},
+        }
+
+    # projects the expenditure and cumulative savings over the next num_mths months (up to MAX_LONG_HORIZON,
+    # a multiple of the months of a period of the granularity, see GRANULARITIES) at the end of each period, returns
+    # - months: number of months from now at the end of each period
+    # - expenditure: category (including housing and invest) -> predicted monthly expenditure at the end of each period
+    # - expenditure_lower, expenditure_upper: its bounds, for the categories affected by prices
+    # - cumulative_savings: the lower, pred and upper cumulative savings at the end of each period
+    # all values are arrays
+    def predict_long_horizon(self, num_mths, granularity="yearly"):
+        step = GRANULARITIES[granularity]
+        periods = {
+            category: self.models.get_period_price_ratios(self.models.forecasts[self.get_model_name(category)], num_mths, step)
+            for category in CATEGORIES
+        }
+        num_periods = num_mths // step
+        expenditure = {}
+        for bound in ["pred", "pred_lower", "pred_upper"]:
+            expenditure[bound] = {category: self.current_expenditure[category] * ratios[bound] for category, ratios in periods.items()}
+        for category in ["housing", "invest"]:
+            expenditure["pred"][category] = np.full(num_periods, float(self.current_expenditure[category]))
+
+        # expenditure over each period, the fixed expenditures do not change
+        fixed = self.current_expenditure["housing"] + self.current_expenditure["invest"]
+        total = {
+            bound: sum(self.current_expenditure[category] * ratios[f"{bound}_sum"] for category, ratios in periods.items()) + step * fixed
+            for bound in ["pred", "pred_lower", "pred_upper"]
+        }
+        income = step * self.take_home
+        return {
+            "months": np.arange(step, num_mths + 1, step),
+            "expenditure": expenditure["pred"],
+            "expenditure_lower": expenditure["pred_lower"],
+            "expenditure_upper": expenditure["pred_upper"],
+            "cumulative_savings": {
+                "lower": (income - total["pred_upper"]).cumsum(),
+                "pred": (income - total["pred"]).cumsum(),
+                "upper": (income - total["pred_lower"]).cumsum(),
+            },
+        }
+
+    # simulates the cumulative savings of the next num_mths months over num_paths price paths, the price of each
+    # category follows its prediction, shifted by a random walk of monthly shocks that are correlated across the
+    # categories like past price changes were (see ForecastModels.build_shock_covariance)
+    # returns the percentiles of the cumulative savings in each month (as a dict of arrays) and the probability
+    # that the cumulative savings are negative in each month
+    def simulate_cumulative_savings(self, num_mths, num_paths=NUM_PATHS, percentiles=PERCENTILES, seed=None):
+        categories = CATEGORIES
+        model_names = [self.get_model_name(category) for category in categories]
+        # predicted spending on each category in each month, without shocks
+        spending = np.stack([self.predict_expenditure(category, num_mths)["pred"] for category in categories])
+        spending = spending.astype(np.float32)[:, :, None]
         fixed = self.current_expenditure["housing"] + self.current_expenditure["invest"]
 
-        # compute the total predicted expenditure for each month
-        total_pred = food_pred["pred"] + transport_pred["pred"] + utilities_pred["pred"] + discretionary_pred["pred"] + fixed
-        total_pred_lower = food_pred["pred_lower"] + transport_pred["pred_lower"] + utilities_pred["pred_lower"] + discretionary_pred["pred_lower"] + fixed
-        total_pred_upper = food_pred["pred_upper"] + transport_pred["pred_upper"] + utilities_pred["pred_upper"] + discretionary_pred["pred_upper"] + fixed
+        # shocks with the covariance of past price changes are standard normal draws times a square root of it
+        # (from its eigendecomposition rather than cholesky, which fails if the covariance is singular)
+        eigenvalues, eigenvectors = np.linalg.eigh(self.models.get_shock_covariance(model_names))
+        scale = (eigenvectors * np.sqrt(np.clip(eigenvalues, 0, None))).astype(np.float32)
 
-        # compute the savings for each month
-        savings = self.take_home - total_pred
-        savings_upper = self.take_home - total_pred_lower # upper bound of savings = monthly income - lower bound of expenditure
-        savings_lower = self.take_home - total_pred_upper # lower bound of savings = monthly income - upper bound of expenditure
+        # paths come in antithetic pairs (the same shocks with opposite signs), which halves the random draws and
+        # reduces the variance of the estimates, float32 and the sfc64 generator make the draws faster
+        rng = np.random.Generator(np.random.SFC64(seed))
+        half = (num_paths + 1) // 2
+        num_paths = 2 * half
+        # percentiles are read from the sorted savings of each month, interpolated linearly like np.percentile
+        positions = np.asarray(percentiles, dtype=np.float64) / 100 * (num_paths - 1)
+        below = np.floor(positions).astype(int)
+        above = np.minimum(below + 1, num_paths - 1)
+        fraction = (positions - below).astype(np.float32)
 
-        # compute the cumulative savings in total
-        savings = savings.cumsum()
-        savings_upper = savings_upper.cumsum()
-        savings_lower = savings_lower.cumsum()
-        
-        print(savings)
+        walk = np.zeros((len(categories), half), dtype=np.float32) # accumulated shocks of each pair of paths
+        cumulative = np.zeros(num_paths, dtype=np.float32) # cumulative savings of each path
+        savings_percentiles = np.empty((num_mths, len(percentiles)))
+        probability_negative = np.empty(num_mths)
+        with stage_timer("simulation"):
+            # the paths are drawn a block of months at a time, so memory does not grow with num_mths
+            block_months = max(1, BLOCK_SIZE // (half * len(categories)))
+            for start in range(0, num_mths, block_months):
+                months = slice(start, min(start + block_months, num_mths))
+                num_block = months.stop - start
+                shocks = scale @ rng.standard_normal((len(categories), num_block * half), dtype=np.float32)
+                shocks = shocks.reshape(len(categories), num_block, half)
+                # random walk, adding up months one at a time is faster than cumsum along a short axis
+                shocks[:, 0] += walk
+                for i in range(1, num_block):
+                    shocks[:, i] += shocks[:, i - 1]
+                walk = shocks[:, -1].copy()
+
+                prices = np.exp(np.concatenate([shocks, -shocks], axis=2))
+                prices *= spending[:, months]
+                savings = np.float32(self.take_home - fixed) - prices.sum(axis=0)
+                savings[0] += cumulative
+                for i in range(1, num_block):
+                    savings[i] += savings[i - 1]
+                cumulative = savings[-1].copy()
+
+                savings.sort(axis=1)
+                savings_percentiles[months] = savings[:, below] * (1 - fraction) + savings[:, above] * fraction
+                probability_negative[months] = (savings < 0).mean(axis=1)
+
+        return dict(zip(percentiles, savings_percentiles.T)), probability_negative
+
+    # predicts cumulative savings in num_mths months for many what-if scenarios at once
+    # scenarios maps state fields (e.g. "discretionary") to arrays with one value per scenario, fields that are
+    # not given keep the engine's current values
+    # returns the lower, pred and upper cumulative savings as arrays of shape (number of scenarios, num_mths)
+    def predict_cumulative_savings_batch(self, scenarios, num_mths):
+        num_scenarios = len(next(iter(scenarios.values()))) if scenarios else 1
+
+        def column(field, default, dtype=float):
+            return np.broadcast_to(np.asarray(scenarios.get(field, default), dtype=dtype), (num_scenarios,))
+
+        use_public_transport = column("use_public_transport", self.use_public_transport, dtype=bool)
+        transport = column("transport", self.current_expenditure["transport"])
+        # spending of each scenario on the categories affected by prices, one column per model
+        # (transport is spent on either public transport or petrol)
+        model_names = ["m_food", "m_tran", "m_petr", "m_util", "m_recr"]
+        spending = np.stack([
+            column("food", self.current_expenditure["food"]),
+            np.where(use_public_transport, transport, 0),
+            np.where(use_public_transport, 0, transport),
+            column("utilities", self.current_expenditure["utilities"]),
+            column("discretionary", self.current_expenditure["discretionary"]),
+        ], axis=1)
+        ratios = [self.get_price_ratios(name, num_mths) for name in model_names]
+
+        # compute fixed expenditures, not affected by prices
+        fixed = column("housing", self.current_expenditure["housing"]) + column("invest", self.current_expenditure["invest"])
+        take_home = column("take_home", self.take_home)
 
-        # return cumulative savings for the last num_mths and the next num_mths
-        return savings_lower.iloc[-(2*num_mths):], savings.iloc[-(2*num_mths):], savings_upper.iloc[-(2*num_mths):]
+        # expenditure is linear in the current spending, so the total for every scenario and month is one matrix product
+        def cumulative_savings(bound):
+            total = spending @ np.stack([r[bound] for r in ratios]) + fixed[:, None]
+            return np.cumsum(take_home[:, None] - total, axis=1)
 
-        # return savings_lower.iloc[-1], savings.iloc[-1], savings_upper.iloc[-1]
+        # upper bound of savings = monthly income - lower bound of expenditure (and vice versa)
+        return cumulative_savings("pred_upper"), cumulative_savings("pred"), cumulative_savings("pred_lower")
     
     # set new values
     def set_new_values(self, food, transport, use_public_transport, utilities, discretionary, housing, invest, take_home):
@@ -0,0 +1,68 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+RESPONSE_CACHE_SIZE = 4096 # number of responses kept
+
+
+# strong etag of a response that is fully determined by the given parts (e.g. the models' version, the
+# month, the user's state and the request), any json-serializable values
+def compute_etag(*parts):
+    key = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+    return '"' + hashlib.sha256(key.encode()).hexdigest()[:32] + '"'
+
+# checks if an If-None-Match header (a list of etags, possibly weak, or *) matches the etag
+def etag_matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    # If-None-Match uses the weak comparison, W/"x" matches "x"
+    return "*" in tags or etag in [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+
+
+# least recently used cache of response bodies keyed by their etag, since the etag covers everything a
+# response depends on, entries never need to be invalidated, outdated ones are just no longer requested
+class ResponseCache():
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # etag -> (status code, body, media type)
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.lock = threading.Lock()
+
+    # returns the cached (status code, body, media type) of the etag, or None
+    def get(self, etag):
+        with self.lock:
+            entry = self.entries.get(etag)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(etag)
+            self.hits += 1
+            return entry
+
+    def add(self, etag, status_code, body, media_type):
+        with self.lock:
+            self.entries[etag] = (status_code, body, media_type)
+            self.entries.move_to_end(etag)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # counts a request answered with 304 Not Modified
+    def count_not_modified(self):
+        with self.lock:
+            self.not_modified += 1
+
+    # cache statistics
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "memory_bytes": sum(len(entry[1]) for entry in self.entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "not_modified": self.not_modified,
+            }
@@ -0,0 +1,87 @@
+import threading
+from collections import OrderedDict
+
+from forecasters import SERIES_PARAMS, forecast_model
+
+MAX_CACHE_BYTES = 256 * 2**20 # memory budget of the cached forecast tables
+MAX_CACHE_ENTRIES = 1000 # most cached forecast tables, whatever their size
+
+
+# helper function, memory held by a forecast table (its arrays)
+def get_size(table):
+    return sum(v.nbytes for v in table.values())
+
+
+# fits a model of a series and forecasts it up to the end month index, returns the forecast table (run in worker
+# processes, only the table is sent back)
+def fit_series(series_name, params, data, end):
+    from model_fitting import fit_models
+
+    fitted, _ = fit_models({series_name: (params, data)}, workers=1)
+    return forecast_model(fitted[series_name], end)
+
+
+# forecast tables of prophet models for the data series of cpi_data.csv, fitted (by the caller, see fit_series)
+# the first time each one is requested, kept in a least recently used cache that is bounded by memory and by
+# number of entries (the models are not needed once they are forecasted), so that any series can be forecasted
+# without fitting or holding all of them
+# forecasters that forecast every series at once (see ForecastModels.series_forecasts) need no fitting,
+# their forecast tables are returned as they are
+class SeriesModelCache():
+    def __init__(self, models, max_bytes=MAX_CACHE_BYTES, params=SERIES_PARAMS, max_entries=MAX_CACHE_ENTRIES):
+        self.models = models # ForecastModels, provides the data and forecasting helpers
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.params = params
+        self.entries = OrderedDict() # series name -> (forecast table, size)
+        self.memory_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    # returns the arguments of fit_series for the series
+    def get_fit_args(self, series_name):
+        return series_name, self.params, self.models.get_series(series_name), self.models.get_forecast_end()
+
+    # returns the cached forecast table of the series (marking it as recently used), or None if it is
+    # not cached (then counted as a miss, to be fitted by the caller and added)
+    def lookup(self, series_name):
+        table = self.models.series_forecasts.get(series_name)
+        if table is not None:
+            return table
+        with self.lock:
+            entry = self.entries.get(series_name)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(series_name)
+            self.hits += 1
+            return entry[0]
+
+    # caches the forecast table of a series and evicts the least recently used ones until the cache fits in
+    # its memory budget and number of entries (the new entry itself is always kept)
+    def add(self, series_name, table):
+        with self.lock:
+            if series_name in self.entries:
+                return
+            entry = (table, get_size(table))
+            self.entries[series_name] = entry
+            self.memory_bytes += entry[1]
+            while (self.memory_bytes > self.max_bytes or len(self.entries) > self.max_entries) and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.memory_bytes -= evicted[1]
+                self.evictions += 1
+
+    # cache statistics
+    def stats(self):
+        with self.lock:
+            return {
+                "series": len(self.entries),
+                "memory_bytes": self.memory_bytes,
+                "max_bytes": self.max_bytes,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,69 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# stores the expenditure state of each user (or session), keyed by user id
+# the most recently used states are kept in memory and the least recently used one is evicted
+# once there are more than capacity of them
+# if db_path is given, states are also written to a sqlite database so that every worker
+# process sees the same states, the in-memory states then only act as a cache
+class StateStore():
+    def __init__(self, capacity=10000, db_path=None):
+        self.capacity = capacity
+        self.states = OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        if db_path is not None:
+            self.db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS states (user_id TEXT PRIMARY KEY, state TEXT NOT NULL, updated REAL NOT NULL)")
+            self.data_version = self.get_data_version()
+
+    # sqlite's data_version changes whenever another connection (i.e. another worker) commits,
+    # which means the cached states may be out of date
+    def get_data_version(self):
+        return self.db.execute("PRAGMA data_version").fetchone()[0]
+
+    # returns the state of the user, or None if there is no state for the user
+    def get(self, user_id):
+        with self.lock:
+            if self.db is not None:
+                data_version = self.get_data_version()
+                if data_version != self.data_version:
+                    self.states.clear()
+                    self.data_version = data_version
+            if user_id in self.states:
+                self.states.move_to_end(user_id)
+                return dict(self.states[user_id])
+            if self.db is None:
+                return None
+            row = self.db.execute("SELECT state FROM states WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None:
+                return None
+            state = json.loads(row[0])
+            self.put_in_memory(user_id, state)
+            return dict(state)
+
+    # sets the state of the user
+    def set(self, user_id, state):
+        with self.lock:
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO states (user_id, state, updated) VALUES (?, ?, ?)",
+                    (user_id, json.dumps(state), time.time()),
+                )
+            self.put_in_memory(user_id, dict(state))
+
+    # helper function, caches the state in memory and evicts the least recently used states
+    def put_in_memory(self, user_id, state):
+        self.states[user_id] = state
+        self.states.move_to_end(user_id)
+        while len(self.states) > self.capacity:
+            self.states.popitem(last=False)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.states)
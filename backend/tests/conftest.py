@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+import shared_modules  # noqa: E402,F401, makes metrics, offload and profiling importable
+# the lightweight models, fitting the prophet ones takes minutes
+os.environ.setdefault("EZBUDGET_FORECASTER", "numpy")
+
+
+# the server, started with its models loaded, the data paths are relative to the backend folder
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+
+    cwd = os.getcwd()
+    os.chdir(BACKEND_DIR)
+    try:
+        import main
+
+        with TestClient(main.app) as client:
+            assert main.ready.wait(60), main.warmup_error
+            yield client
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,77 @@
+ORIGIN = "http://localhost:3000"
+
+
+def test_cors_headers_on_cached_responses(client):
+    url = "/predict/predict_cumulative_savings/3?user_id=cors-test"
+    headers = {"Origin": ORIGIN}
+    first = client.get(url, headers=headers)
+    assert first.status_code == 200
+    assert first.headers["access-control-allow-origin"] == ORIGIN
+
+    # answered from the server-side cache
+    hits = client.get("/predict/cache").json()["hits"]
+    cached = client.get(url, headers=headers)
+    assert client.get("/predict/cache").json()["hits"] == hits + 1
+    assert cached.status_code == 200
+    assert cached.json() == first.json()
+    assert cached.headers["access-control-allow-origin"] == ORIGIN
+
+    not_modified = client.get(url, headers={**headers, "If-None-Match": first.headers["etag"]})
+    assert not_modified.status_code == 304
+    assert not_modified.headers["access-control-allow-origin"] == ORIGIN
+
+
+def test_refresh_during_request_keeps_the_models_of_the_etag(client, monkeypatch):
+    import copy
+
+    import main
+    from prediction_engine import PredictionEngine
+    from series_cache import SeriesModelCache
+
+    old_series_models = main.series_models
+    refreshed = copy.copy(old_series_models.models)
+    refreshed.version = "refreshed"
+    used = []
+    predict = PredictionEngine.predict_cumulative_savings
+
+    # the models are swapped in (as by /admin/refresh) while the handler runs
+    def predict_during_refresh(self, num_mths):
+        monkeypatch.setattr(main, "series_models", SeriesModelCache(refreshed))
+        monkeypatch.setattr(main, "models", refreshed)
+        used.append(self.models)
+        return predict(self, num_mths)
+
+    monkeypatch.setattr(PredictionEngine, "predict_cumulative_savings", predict_during_refresh)
+    response = client.get("/predict/predict_cumulative_savings/4?user_id=refresh-test")
+    assert response.status_code == 200
+    assert used == [old_series_models.models]
+    # the response is cached under the etag of the models it was computed with
+    assert response.headers["etag"] == main.compute_etag(
+        old_series_models.models.version,
+        old_series_models.models.get_today_month_index(),
+        main.state,
+        "/predict/predict_cumulative_savings/4",
+        [("user_id", "refresh-test")],
+    )
+
+
+def test_admin_refresh(client, monkeypatch):
+    import time
+
+    import main
+
+    monkeypatch.setattr(main, "ADMIN_TOKEN", None)
+    assert client.post("/admin/refresh").status_code == 404
+
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "secret")
+    assert client.post("/admin/refresh", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    old_models = main.models
+    response = client.post("/admin/refresh", headers={"X-Admin-Token": "secret"})
+    assert response.status_code == 202
+    for _ in range(600):
+        status = client.get("/admin/refresh", headers={"X-Admin-Token": "secret"}).json()
+        if status["status"] != "running":
+            break
+        time.sleep(0.1)
+    assert status["status"] == "done"
+    assert main.models is not old_models
@@ -0,0 +1,46 @@
+import os
+import threading
+import time
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from profiling import add_profiling
+
+
+# busy python code, long enough to be sampled
+def spin(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        sum(range(1000))
+
+
+def busy_elsewhere(stopped):
+    while not stopped.is_set():
+        spin(0.01)
+
+
+def test_profile_only_samples_the_request(tmp_path):
+    app = FastAPI()
+    add_profiling(app, profile_dir=str(tmp_path), sample_rate=0, admin_token=None)
+
+    @app.get("/spin")
+    def read_spin():
+        spin(0.2)
+        return {}
+
+    stopped = threading.Event()
+    other = threading.Thread(target=busy_elsewhere, args=(stopped,), name="other request")
+    other.start()
+    try:
+        with TestClient(app) as client:
+            response = client.get("/spin", headers={"X-Profile": "1"})
+    finally:
+        stopped.set()
+        other.join()
+
+    with open(os.path.join(tmp_path, response.headers["X-Profile"] + ".folded")) as f:
+        stacks = f.read().splitlines()
+    assert stacks
+    assert all("read_spin" in stack for stack in stacks)
+    assert not any("busy_elsewhere" in stack for stack in stacks)
@@ -0,0 +1,223 @@
+"""
+Optimizes the budgets of a whole population of users at once.
+
+Reads budgets (rows with the fields of BudgetInput in experta-system-v2.py, and optionally a user_id) from a
+CSV, NDJSON or Parquet file, solves them in parallel in chunks across worker processes and streams one result
+per row, in input order, with its status and solve time, as NDJSON or CSV:
+
+    python batch_optimize.py budgets.csv results.ndjson --workers 8
+    python batch_optimize.py budgets.parquet results.csv --weights '{"food": 2, "savings": 3}'
+"""
+import argparse
+import contextlib
+import csv
+import io
+import itertools
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from csp_solver_v4 import CATEGORIES, WEIGHT_NAMES, get_weight_mapping, optimize_budget_with_weighted_quadratic_loss_custom_units
+
+CHUNK_SIZE = 500 # rows solved per task sent to a worker process
+
+# fields of BudgetInput in experta-system-v2.py and their types
+BUDGET_FIELDS = {
+    "age": int,
+    "number_of_kids": int,
+    "monthly_take_home": float,
+    "planning_to_buy_home": bool,
+    "repaying_home_loans": bool,
+    "supporting_aged_parents": bool,
+    "owns_car": bool,
+    "transport_expenditure": float,
+    "food_expenditure": float,
+    "housing_expenditure": float,
+    "insurance_expenditure": float,
+    "other_needs_expenditure": float,
+    "emergency_funds": float,
+    "investment_expenditure": float,
+    "monthly_savings": float,
+}
+
+# columns of the results
+RESULT_FIELDS = ["row", "user_id", "status", "error", "seconds", "loss"] + CATEGORIES
+
+FORMATS = {".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson", ".parquet": "parquet"}
+
+
+# helper function, format of a file from its extension
+def get_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError(f"Unknown format of {path}, must be one of {sorted(FORMATS)}")
+    return FORMATS[extension]
+
+# key of the rows read_rows yields for lines it cannot read, parse_budget reports them as invalid
+ROW_ERROR = "_error"
+
+# reads the rows of a csv, ndjson or parquet file (a path, or a binary file object with the format given)
+# as dicts, one at a time
+# the format (and for parquet, pyarrow and the file's metadata) is checked right away, raising ValueError, so
+# callers can report it before reading any row; ndjson lines that are not json objects are yielded as
+# {ROW_ERROR: message} instead of stopping the reading
+def read_rows(source, format=None):
+    format = format or get_format(source)
+    if format == "parquet":
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ValueError("Reading parquet files needs pyarrow (pip install pyarrow)")
+        return (row for batch in pq.ParquetFile(source).iter_batches(batch_size=CHUNK_SIZE) for row in batch.to_pylist())
+    if format not in ("csv", "ndjson"):
+        raise ValueError(f"Unknown format {format}")
+    return read_text_rows(source, format)
+
+# helper function, reads the rows of a csv or ndjson file for read_rows
+def read_text_rows(source, format):
+    with (open(source, "rb") if isinstance(source, str) else source) as f:
+        # undecodable bytes become invalid values of their row rather than an error
+        text = io.TextIOWrapper(f, encoding="utf-8", errors="replace", newline="")
+        if format == "csv":
+            yield from csv.DictReader(text)
+            return
+        for number, line in enumerate(text, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield {ROW_ERROR: f"line {number}: invalid json ({e})"}
+                continue
+            yield row if isinstance(row, dict) else {ROW_ERROR: f"line {number}: not a json object"}
+
+# helper function, converts a value read from a file to a field's type, raises ValueError if it cannot
+def convert(value, field_type):
+    if isinstance(value, str):
+        value = value.strip()
+        if field_type is bool:
+            if value.lower() not in ("true", "false", "1", "0", "yes", "no"):
+                raise ValueError(f"invalid boolean {value!r}")
+            return value.lower() in ("true", "1", "yes")
+    if field_type is int and float(value) != int(float(value)):
+        raise ValueError(f"invalid integer {value!r}")
+    return field_type(float(value)) if field_type is int else field_type(value)
+
+# converts a row to a budget like /optimize-budget does (fields of BudgetInput, floats truncated to integers),
+# raises ValueError if a field is missing or invalid
+def parse_budget(row):
+    if ROW_ERROR in row:
+        raise ValueError(row[ROW_ERROR])
+    budget = {}
+    for field, field_type in BUDGET_FIELDS.items():
+        value = row.get(field)
+        if value is None or value == "":
+            raise ValueError(f"missing {field}")
+        try:
+            value = convert(value, field_type)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"{field}: {e}")
+        budget[field] = int(value) if isinstance(value, float) else value
+    return budget
+
+# optimizes one row, returns its result: row number, user_id (if the row has one), status ("ok", "infeasible"
+# or "invalid"), error, solve time, loss and the optimized allocation of each category
+def optimize_row(number, row, weight_mapping):
+    result = {"row": number, "user_id": row.get("user_id"), "status": "ok", "error": None, "seconds": None, "loss": None}
+    try:
+        budget = parse_budget(row)
+    except ValueError as e:
+        return {**result, "status": "invalid", "error": str(e)}
+
+    start = time.perf_counter()
+    allocation, loss = optimize_budget_with_weighted_quadratic_loss_custom_units(budget, weight_mapping)
+    result["seconds"] = time.perf_counter() - start
+    if allocation is None:
+        return {**result, "status": "infeasible"}
+    return {**result, "loss": loss, **allocation}
+
+# optimizes a chunk of (row number, row), runs in worker processes
+def optimize_chunk(numbered_rows, weight_mapping):
+    return [optimize_row(number, row, weight_mapping) for number, row in numbered_rows]
+
+# helper function, splits numbered rows into lists of chunk_size
+def get_chunks(rows, chunk_size=CHUNK_SIZE):
+    numbered_rows = enumerate(rows)
+    while True:
+        chunk = list(itertools.islice(numbered_rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+# optimizes every row in chunks across worker processes (defaults to the number of cpus) and yields the
+# results in input order as they are done, at most 2 chunks per worker are queued, so memory stays bounded
+# however many rows there are
+def optimize_rows(rows, weights=None, workers=None, chunk_size=CHUNK_SIZE):
+    weight_mapping = get_weight_mapping(weights)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        # not worth starting processes for
+        for chunk in get_chunks(rows, chunk_size):
+            yield from optimize_chunk(chunk, weight_mapping)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in get_chunks(rows, chunk_size):
+            pending.append(executor.submit(optimize_chunk, chunk, weight_mapping))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+# writes results to a text file object as ndjson or csv, one line per result as they come
+def write_results(results, f, format="ndjson"):
+    if format == "csv":
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
+            yield result
+    elif format == "ndjson":
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+            yield result
+    else:
+        raise ValueError(f"Results can only be written as csv or ndjson, not {format}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Optimize the budgets of many users at once.")
+    parser.add_argument("input", help="csv, ndjson or parquet file of budgets")
+    parser.add_argument("output", nargs="?", default="-", help="csv or ndjson file of results (default: ndjson to stdout)")
+    parser.add_argument("--workers", type=int, help="number of worker processes (default: number of cpus)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="rows per task sent to a worker")
+    parser.add_argument("--weights", type=json.loads, help='weights as json, e.g. {"food": 2, "savings": 3} (default: all 1)')
+    args = parser.parse_args()
+
+    weights = None
+    if args.weights:
+        unknown = set(args.weights) - set(WEIGHT_NAMES)
+        if unknown:
+            parser.error(f"unknown weights {sorted(unknown)}, must be among {list(WEIGHT_NAMES)}")
+        weights = {name: args.weights.get(name, 1) for name in WEIGHT_NAMES}
+
+    start = time.perf_counter()
+    counts = {"ok": 0, "infeasible": 0, "invalid": 0}
+    format = "ndjson" if args.output == "-" else get_format(args.output)
+    with (open(args.output, "w", newline="") if args.output != "-" else contextlib.nullcontext(sys.stdout)) as f:
+        results = optimize_rows(read_rows(args.input), weights, workers=args.workers, chunk_size=args.chunk_size)
+        for result in write_results(results, f, format):
+            counts[result["status"]] += 1
+
+    elapsed = time.perf_counter() - start
+    total = sum(counts.values())
+    print(f"{total} rows in {elapsed:.2f}s ({total / elapsed:.0f} rows/s): "
+          + ", ".join(f"{count} {status}" for status, count in counts.items()), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+Evaluates the rules of BudgetAdvisor (experta-system-v2.py) over a whole table of budgets at once.
+
+Each rule is a NumPy mask over the columns of a DataFrame of budgets (the fields of BudgetInput), so a table
+of a million users is analyzed in a fraction of a second instead of building and running a rule engine per
+user. The result is a code for each recommendation, the messages are in RECOMMENDATIONS:
+
+    python budget_rules.py budgets.csv advice.ndjson
+"""
+import argparse
+import contextlib
+import io
+import json
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from batch_optimize import BUDGET_FIELDS, get_format
+
+# recommendation code -> message, BudgetAdvisor appends the same messages
+RECOMMENDATIONS = {
+    "reduce_needs": "Your spending on necessities are too high! "
+        "The recommended spending on needs is maximum 50% of your take-home salary.",
+    "public_transport": "Your transport spendings are above average. Consider taking public transport instead of using private options.",
+    "reduce_insurance": "Your spending on insurance is too high! "
+        "The recommended spending on insurance is maximum 15% of your take home-salary.",
+    "reduce_food": "Your spending on food are too high! "
+        "The recommended spending on food is maximum 15% of your take-home salary.",
+    "housing_alternatives": "You may want to consider looking for alternative housing options "
+        "as housing costs are over 35% of your take-home salary.",
+    "reduce_wants": "Your spending on wants are too high! "
+        "The recommended spending on wants is maximum 30% of your take-home salary.",
+    "increase_savings": "Your savings are too low! You are recommended to save 20% of your take-home salary. "
+        "You can increase your monthly savings by reducing spending on needs or wants.",
+    "invest_retirement": "Consider investing in long-term plans (e.g. ETFs) for retirement.",
+    "invest_education": "Consider short-term investment plans for your kids' tertiary education.",
+    "invest_home_loan": "Consider short-term investment plans to help with home loan repayment.",
+    "emergency_funds_low": "Financial experts recommend maintaining an emergency fund covering 3-6 months of your monthly expenses. "
+        "Currently, your savings fall short of the 3-month minimum. "
+        "To avoid financial stress during unexpected events, please consider increasing your savings as soon as possible.",
+    "emergency_funds_medium": "Financial experts recommend maintaining an emergency fund covering 3-6 months of your monthly expenses. "
+        "Build up your emergency funds to cover at least 6 months of your current expenses.",
+}
+
+# salience of the BudgetAdvisor rule each recommendation comes from, the engine fires rules by decreasing salience
+# (the order of rules with the same salience is arbitrary, here they are in the order of RECOMMENDATIONS)
+SALIENCE = {
+    "reduce_needs": 10,
+    "public_transport": 9,
+    "reduce_insurance": 9,
+    "reduce_food": 9,
+    "housing_alternatives": 9,
+    "reduce_wants": 8,
+    "increase_savings": 7,
+    "invest_retirement": 6,
+    "invest_education": 6,
+    "invest_home_loan": 6,
+    "emergency_funds_low": 5,
+    "emergency_funds_medium": 5,
+}
+
+# codes in the order their recommendations are given
+CODES = list(RECOMMENDATIONS)
+
+
+# evaluates every rule over a DataFrame of budgets (one row per budget, the fields of BudgetInput as columns),
+# returns a DataFrame with the same index and a boolean column per code (see CODES)
+# the arithmetic is done in the same order as in BudgetAdvisor, so the results are identical, also at the thresholds
+def evaluate_rules(budgets):
+    column = lambda field: budgets[field].to_numpy(dtype=np.float64)
+    take_home = column("monthly_take_home")
+    transport = column("transport_expenditure")
+    food = column("food_expenditure")
+    housing = column("housing_expenditure")
+    insurance = column("insurance_expenditure")
+    others = column("other_needs_expenditure")
+    savings = column("monthly_savings")
+    funds = column("emergency_funds")
+    expenses = take_home - savings
+    low_investment = column("investment_expenditure") < 0.1 * take_home
+
+    flags = {
+        "reduce_needs": (transport + food + housing + insurance + others) > 0.5 * take_home,
+        "public_transport": ~budgets["owns_car"].to_numpy(dtype=bool) & (transport > 150),
+        "reduce_insurance": insurance > 0.15 * take_home,
+        "reduce_food": food > 0.15 * take_home,
+        "housing_alternatives": housing > 0.35 * take_home,
+        "reduce_wants": (take_home - savings - transport - food - housing - insurance - others) > 0.3 * take_home,
+        "increase_savings": savings < 0.2 * take_home,
+        "invest_retirement": low_investment & (column("age") < 65),
+        "invest_education": low_investment & (column("number_of_kids") > 0),
+        "invest_home_loan": low_investment & budgets["planning_to_buy_home"].to_numpy(dtype=bool),
+        "emergency_funds_low": funds < 3 * expenses,
+        "emergency_funds_medium": (funds > 3 * expenses) & (funds < 6 * expenses),
+    }
+    return pd.DataFrame({code: flags[code] for code in CODES}, index=budgets.index)
+
+# returns the list of recommendation codes of each row of evaluate_rules' flags, in the order they are given
+def get_codes(flags):
+    # each row's flags as the bits of an integer, there are few distinct combinations so each is only converted once
+    masks = flags.to_numpy() @ (1 << np.arange(len(CODES)))
+    combinations = {mask: [code for i, code in enumerate(CODES) if mask >> i & 1] for mask in np.unique(masks).tolist()}
+    return [combinations[mask] for mask in masks.tolist()]
+
+# recommendations (messages) of a budget (a dict with the fields of BudgetInput), like BudgetAdvisor gives them
+def advise_budget(budget):
+    flags = evaluate_rules(pd.DataFrame([budget]))
+    return [RECOMMENDATIONS[code] for code in get_codes(flags)[0]]
+
+# compares the recommendations of the rule engine (advise, a function of a budget that returns its messages, e.g.
+# advise in experta-system-v2.py) with advise_budget on each budget, returns the budgets they differ on
+# rules with the same salience may fire in any order, so only the order of the saliences is compared
+def find_differences(advise, budgets):
+    order = {message: (-SALIENCE[code], CODES.index(code)) for code, message in RECOMMENDATIONS.items()}
+    differences = []
+    for budget in budgets:
+        recommendations = advise(budget)
+        saliences = [order[message][0] for message in recommendations]
+        if saliences != sorted(saliences) or sorted(recommendations, key=order.get) != advise_budget(budget):
+            differences.append(budget)
+    return differences
+
+
+# helper function, converts the values of a boolean column read from a file (true/false, 1/0, yes/no) to bools,
+# NaN if not one of these
+def to_bool(values):
+    if values.dtype == bool:
+        return values
+    return values.astype(str).str.strip().str.lower().map(
+        {"true": True, "1": True, "1.0": True, "yes": True, "false": False, "0": False, "0.0": False, "no": False}
+    )
+
+# reads a csv, ndjson or parquet file (a path, or a binary file object with the format given) of budgets into a
+# DataFrame with the fields of BudgetInput converted to their types, and a "valid" column that is False for rows
+# with a missing or invalid field, raises ValueError if a field is missing altogether
+def read_budgets(source, format=None):
+    format = format or get_format(source)
+    if format == "parquet":
+        try:
+            budgets = pd.read_parquet(source)
+        except ImportError:
+            raise ValueError("Reading parquet files needs pyarrow (pip install pyarrow)")
+    elif format == "csv":
+        budgets = pd.read_csv(source)
+    elif format == "ndjson":
+        budgets = pd.read_json(source, lines=True)
+    else:
+        raise ValueError(f"Unknown format {format}")
+
+    missing = [field for field in BUDGET_FIELDS if field not in budgets]
+    if missing:
+        raise ValueError(f"Missing columns {missing}")
+    valid = np.ones(len(budgets), dtype=bool)
+    for field, field_type in BUDGET_FIELDS.items():
+        values = to_bool(budgets[field]) if field_type is bool else pd.to_numeric(budgets[field], errors="coerce")
+        valid &= values.notna().to_numpy()
+        budgets[field] = values.fillna(False if field_type is bool else 0).astype(bool if field_type is bool else np.float64)
+    budgets["valid"] = valid
+    return budgets
+
+# analyzes a DataFrame of read_budgets, returns the result of each row: row number, user_id (if there is a
+# user_id column), status ("ok" or "invalid") and recommendation codes
+def analyze_budgets(budgets):
+    flags = evaluate_rules(budgets)
+    flags.loc[~budgets["valid"].to_numpy()] = False
+    user_ids = [None] * len(budgets)
+    if "user_id" in budgets:
+        user_ids = budgets["user_id"].astype(object).where(budgets["user_id"].notna(), None).tolist()
+    statuses = np.where(budgets["valid"].to_numpy(), "ok", "invalid").tolist()
+    return [
+        {"row": row, "user_id": user_id, "status": status, "codes": codes}
+        for row, (user_id, status, codes) in enumerate(zip(user_ids, statuses, get_codes(flags)))
+    ]
+
+# analyzes a csv, ndjson or parquet file (the bytes of it) and returns the results as ndjson, runs in worker processes
+def analyze_file(data, format):
+    results = analyze_budgets(read_budgets(io.BytesIO(data), format))
+    return "".join(json.dumps(result) + "\n" for result in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze the budgets of many users at once.")
+    parser.add_argument("input", help="csv, ndjson or parquet file of budgets")
+    parser.add_argument("output", nargs="?", default="-", help="ndjson file of recommendation codes (default: stdout)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    budgets = read_budgets(args.input)
+    read_time = time.perf_counter() - start
+    results = analyze_budgets(budgets)
+    analyze_time = time.perf_counter() - start - read_time
+
+    with (open(args.output, "w") if args.output != "-" else contextlib.nullcontext(sys.stdout)) as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+
+    print(f"{len(results)} rows ({int((~budgets['valid']).sum())} invalid), read in {read_time:.2f}s, "
+          f"analyzed in {analyze_time:.2f}s, {time.perf_counter() - start:.2f}s in total", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -16,9 +16,60 @@
 # %pip install ortools
 
 # %%
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+
 from ortools.sat.python import cp_model
 
-def optimize_budget_with_weighted_quadratic_loss_custom_units(current_allocations, custom_weights=None, scale=1000):
+import shared_modules  # noqa: F401, makes metrics, offload and profiling importable
+from metrics import observe_stage, stage_timer
+
+logger = logging.getLogger(__name__)
+
+# Budget categories, the needs add up to total_needs.
+NEEDS = ['transport_expenditure', 'food_expenditure', 'housing_expenditure', 'insurance_expenditure', 'other_needs_expenditure']
+CATEGORIES = NEEDS + ['investment_expenditure', 'monthly_savings', 'total_needs', 'total_wants']
+
+# Hard constraints, as shares of the income.
+MIN_SAVINGS_SHARE = 0.2
+MAX_NEEDS_SHARE = 0.5
+MAX_WANTS_SHARE = 0.3
+
+# Step (in dollars) each category is allocated in.
+FACTORS = {cat: 10 if cat == 'transport_expenditure' else 50 for cat in CATEGORIES}
+
+# Solver used by default: "fast" (falls back to CP-SAT for problems it does not handle), "cp_sat",
+# or "check" (solves with both and logs an error if the optimal losses differ).
+SOLVER = "fast"
+
+# CP-SAT search parameters used by default: time limit in seconds (None for no limit, the solver then runs until
+# the solution is proven optimal) and number of parallel search workers (0 lets CP-SAT choose).
+TIME_LIMIT = None
+NUM_WORKERS = 0
+
+# Names of the weights taken by /optimize-budget -> category.
+WEIGHT_NAMES = {
+    'transport': 'transport_expenditure',
+    'food': 'food_expenditure',
+    'housing': 'housing_expenditure',
+    'insurance': 'insurance_expenditure',
+    'other_needs': 'other_needs_expenditure',
+    'savings': 'monthly_savings',
+    'investments': 'investment_expenditure',
+}
+
+def get_weight_mapping(weights=None):
+    """
+    Converts weights by name (see WEIGHT_NAMES, 1 if missing) to integer custom weights by category.
+    """
+    weights = weights or {}
+    return {cat: int(weights.get(name, 1)) for name, cat in WEIGHT_NAMES.items()}
+
+def optimize_budget_with_weighted_quadratic_loss_custom_units(current_allocations, custom_weights=None, scale=1000, solver=SOLVER, cache=None,
+                                                              time_limit=TIME_LIMIT, num_workers=NUM_WORKERS, round_amounts=False):
     """
     Optimize budget allocation while penalizing deviations from current allocations using a weighted quadratic loss.
     In this version, the allocations are constrained to be in fixed steps:
@@ -32,113 +83,454 @@ def optimize_budget_with_weighted_quadratic_loss_custom_units(current_allocation
     Arguments:
       current_allocations: dict mapping category names (e.g., 'savings', 'housing', etc.) to their current dollar allocations.
       scale: a constant used to determine the weight for each category.
+      solver: "fast", "cp_sat" or "check" (see SOLVER).
+      cache: optional SolutionCache, solutions are then looked up in and added to the cache, CP-SAT starting from
+        the nearest cached solution.
+      time_limit, num_workers: CP-SAT search parameters (see TIME_LIMIT and NUM_WORKERS), when the time limit is hit
+        the best solution found so far is returned (and not cached).
+      round_amounts: if True, the current allocations are rounded to their steps before solving (see canonicalize),
+        an approximation that lets nearby budgets share cached solutions.
       
     Returns:
       A tuple (result, total_weighted_quad_loss) where:
         - result is a dict with the effective (dollar) allocation for each category,
         - total_weighted_quad_loss is the sum of the weighted quadratic losses.
     """
-    model = cp_model.CpModel()
-    
     income = int(current_allocations.get('monthly_take_home', 0))
+    if cache is None:
+        current, weights = get_current_and_weights(current_allocations, custom_weights, scale)
+        return solve(income, current, weights, solver, time_limit=time_limit, num_workers=num_workers)
+
+    key, current, weights = canonicalize(current_allocations, custom_weights, scale, round_amounts)
+    solution = cache.get(key)
+    if solution is None:
+        if solver == "fast":
+            with stage_timer("fast_solve"):
+                solution = solve_fast(income, current, weights) if income > 0 else (None, None)
+        if solution is None:
+            # The fast solver already ran and does not handle the problem, CP-SAT solves it.
+            statuses = []
+            solution = solve(income, current, weights, "cp_sat" if solver == "fast" else solver, cache.nearest(key),
+                             time_limit, num_workers, on_solution=lambda *args: statuses.append(args[-1]))
+            # Only solutions proven optimal are cached: the last report is the final one, and there is none if the
+            # search ended (e.g. at the time limit) without finding a solution.
+            if statuses and statuses[-1]:
+                cache.add(key, solution)
+        else:
+            cache.add(key, solution)
+    return solution
+
+def solve(income, current, weights, solver=SOLVER, hint=None, time_limit=TIME_LIMIT, num_workers=NUM_WORKERS, on_solution=None,
+          stopper=None):
+    """
+    Solves the allocation problem for the current allocations and weights of get_current_and_weights with the solver
+    (see SOLVER), returns (result, total_weighted_quad_loss) or (None, None) if infeasible (or if CP-SAT found
+    no solution within the time limit).
+    hint, time_limit, num_workers, on_solution and stopper are passed to solve_with_cp_sat, the fast solver reports its
+    (optimal) solution to on_solution once.
+    """
     if income <= 0:
         return None, None  # Handle zero/negative income case
 
-    # Define budget categories.
-    categories = ['transport_expenditure', 'food_expenditure', 'housing_expenditure', 'insurance_expenditure', 'other_needs_expenditure',
-                  'investment_expenditure', 'monthly_savings', 'total_needs', 'total_wants']
+    cp_sat_args = (hint, time_limit, num_workers, on_solution, stopper)
+    if solver == "cp_sat":
+        return solve_with_cp_sat(income, current, weights, *cp_sat_args)
+    start = time.perf_counter()
+    with stage_timer("fast_solve"):
+        solution = solve_fast(income, current, weights)
+    if solution is None:
+        # Outside of what the fast solver handles.
+        return solve_with_cp_sat(income, current, weights, *cp_sat_args)
+    if solver == "check":
+        reference = solve_with_cp_sat(income, current, weights, hint)
+        losses = (solution[1], reference[1])
+        if losses[0] != losses[1] and (None in losses or not math.isclose(*losses, rel_tol=1e-9)):
+            logger.error("fast solver loss %s differs from CP-SAT loss %s for %s", *losses, current)
+            solution = reference
+    if on_solution is not None and solution[0] is not None:
+        on_solution(solution[0], solution[1], solution[1], time.perf_counter() - start, True)
+    return solution
+
+def canonicalize(current_allocations, custom_weights=None, scale=1000, round_amounts=False):
+    """
+    Returns (key, current, weights): a hashable key of the problem (income, current allocations and weights) and the
+    current allocations and weights of get_current_and_weights.
+    If round_amounts is True, the current allocation of each category is first rounded to the nearest multiple of its
+    step, so that inputs that differ by less than half a step are the same problem. This is an approximation: the
+    solution of the rounded problem may differ from the exact one, so it is only done when asked for.
+    """
+    current_allocations = dict(current_allocations)
+    if round_amounts:
+        for cat in NEEDS + ['investment_expenditure', 'monthly_savings']:
+            if isinstance(current_allocations.get(cat), (float, int)):
+                current_allocations[cat] = round(current_allocations[cat] / FACTORS[cat]) * FACTORS[cat]
+    current, weights = get_current_and_weights(current_allocations, custom_weights, scale)
+    key = (int(current_allocations.get('monthly_take_home', 0)),) \
+        + tuple(current[cat] for cat in CATEGORIES) + tuple(weights[cat] for cat in CATEGORIES)
+    return key, current, weights
+
+class SolutionCache():
+    """
+    Least recently used cache of solutions by problem key (see canonicalize), so that re-optimizing a budget that
+    was already optimized (e.g. a slider moved back) takes no solving.
+    """
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> (result, total_weighted_quad_loss)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the cached solution of the problem (marking it as recently used), or None if it is not cached.
+        """
+        with self.lock:
+            solution = self.entries.get(key)
+            if solution is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return solution
+
+    def nearest(self, key):
+        """
+        Returns the cached feasible allocation of the problem closest to the given one (by the sum of the differences
+        of income and current allocations), or None if there is none. Used as a hint for CP-SAT.
+        """
+        amounts = key[:len(CATEGORIES) + 1]
+        with self.lock:
+            candidates = [(other, solution[0]) for other, solution in self.entries.items() if solution[0] is not None]
+        if not candidates:
+            return None
+        _, result = min(candidates, key=lambda c: sum(abs(a - b) for a, b in zip(c[0], amounts)))
+        return result
+
+    def add(self, key, solution):
+        """
+        Caches the solution of the problem, evicting the least recently used ones beyond max_entries.
+        """
+        with self.lock:
+            self.entries[key] = solution
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "solutions": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+def get_current_and_weights(current_allocations, custom_weights=None, scale=1000):
+    """
+    Returns the current (integer) allocation of each category, including total_needs and total_wants,
+    and the weight of each category.
+    """
+    income = int(current_allocations.get('monthly_take_home', 0))
 
     # Convert current allocations to integers
     current_allocations = {k: int(v) if isinstance(v, (float, int)) else v 
                          for k, v in current_allocations.items()}
-    # Define the step factor for each category:
-    # For transport we want increments of 10 dollars and for others increments of 50 dollars.
-    factors = {}
-    for cat in categories:
-        if cat == 'transport_expenditure':
-            factors[cat] = 10
-        else:
-            factors[cat] = 50
     
     # We update current allocations for total_needs and total_wants based on the provided
     # breakdown. For example, we set current total_needs as the sum of transport, food, housing,
     # insurance, and other_needs. Then current_total_wants is derived to ensure total income
     # equals savings + total_needs + total_wants.
     current_total_needs = 0
-    for cat in ['transport_expenditure', 'food_expenditure', 'housing_expenditure', 'insurance_expenditure', 'other_needs_expenditure']:
+    for cat in NEEDS:
         current_total_needs += current_allocations.get(cat, 0)
     current_total_wants = income - current_total_needs - current_allocations.get('monthly_savings', 0)
     current_allocations['total_needs'] = current_total_needs
     current_allocations['total_wants'] = current_total_wants
+    current = {cat: current_allocations.get(cat, 0) for cat in CATEGORIES}
     
     # Compute a weight for each category based on its current allocation.
     # A lower current allocation gives a higher weight.
     weights = {}
-    for cat in categories:
+    for cat in CATEGORIES:
         if custom_weights and cat in custom_weights:
             weights[cat] = custom_weights[cat]
         else:
-            current_val = current_allocations.get(cat, 0)
+            current_val = current[cat]
             weights[cat] = scale / (current_val + 1)
             weights[cat] = max(1, int(round(weights[cat])))
-    
-    # Dictionaries to hold decision variables.
-    unit_vars = {}   # decision variables in units
-    alloc_vars = {}  # effective allocations (in dollars)
-    quad_vars = {}   # quadratic loss variables (deviation squared)
-    weighted_quad_terms = []  # objective terms
-    
-    # Create decision variables for each category.
-    for cat in categories:
-        factor = factors[cat]
-        max_units = income // factor  # maximum units so that effective allocation <= income.
-        unit_vars[cat] = model.NewIntVar(0, max_units, f"{cat}_units")
+    return current, weights
+
+class SearchStopper():
+    """
+    Stops a CP-SAT search from another thread, e.g. when the client waiting for it is gone. A search started after
+    stop was called returns right away.
+    """
+    def __init__(self):
+        self.solver = None
+        self.stopped = False
+        self.lock = threading.Lock()
+
+    def attach(self, solver):
+        """
+        Registers the solver of the search about to start, returns True if the search is already stopped.
+        """
+        with self.lock:
+            self.solver = solver
+            return self.stopped
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            if self.solver is not None:
+                self.solver.StopSearch()
+
+class SolutionReporter(cp_model.CpSolverSolutionCallback):
+    """
+    Calls on_solution(result, total_weighted_quad_loss, bound, seconds, optimal) with every improving solution
+    CP-SAT finds, bound being the best lower bound of the loss proven so far. optimal is False for these, once the
+    search is over the last solution is reported again with optimal True if it was proven optimal.
+    """
+    def __init__(self, alloc_vars, on_solution):
+        super().__init__()
+        self.alloc_vars = alloc_vars
+        self.on_solution = on_solution
+
+    def on_solution_callback(self):
+        result = {cat: self.Value(var) for cat, var in self.alloc_vars.items()}
+        self.on_solution(result, int(self.ObjectiveValue()), int(self.BestObjectiveBound()), self.WallTime(), False)
+
+def solve_with_cp_sat(income, current_allocations, weights, hint=None, time_limit=TIME_LIMIT, num_workers=NUM_WORKERS, on_solution=None,
+                      stopper=None):
+    """
+    Solves the allocation problem with CP-SAT, returns (result, total_weighted_quad_loss) or (None, None) if infeasible.
+    hint is an optional allocation (e.g. the solution of a similar problem) the search starts from.
+    time_limit and num_workers are search parameters (see TIME_LIMIT and NUM_WORKERS), when the time limit is hit
+    the best solution found so far is returned, or (None, None) if none was found.
+    on_solution is an optional function called with each improving solution as it is found (see SolutionReporter).
+    stopper is an optional SearchStopper, a stopped search returns the best solution found so far like a time limit.
+    """
+    return CpSatBudgetModel(income, current_allocations).solve(weights, hint, time_limit, num_workers, on_solution, stopper)
+
+class CpSatBudgetModel():
+    """
+    CP-SAT model of the allocation problem for an income and current allocations. The variables and constraints
+    do not depend on the weights, so the model is built once and can be solved for any number of weights, only
+    the objective is replaced.
+    """
+    def __init__(self, income, current_allocations):
+        build_start = time.perf_counter()
+        self.income = income
+        model = cp_model.CpModel()
+        categories = CATEGORIES
+
+        # Define the step factor for each category:
+        # For transport we want increments of 10 dollars and for others increments of 50 dollars.
+        factors = FACTORS
         
-        # Effective dollar allocation for this category.
-        alloc_vars[cat] = model.NewIntVar(0, income, f"{cat}_allocation")
-        model.Add(alloc_vars[cat] == unit_vars[cat] * factor)
+        # Dictionaries to hold decision variables.
+        unit_vars = {}   # decision variables in units
+        alloc_vars = {}  # effective allocations (in dollars)
+        quad_vars = {}   # quadratic loss variables (deviation squared)
         
-        # Compute deviation from the current allocation (in dollars).
-        current_val = current_allocations.get(cat, 0)
-        dev = model.NewIntVar(-income, income, f"dev_{cat}")
-        model.Add(dev == alloc_vars[cat] - current_val)
+        # Create decision variables for each category.
+        for cat in categories:
+            factor = factors[cat]
+            max_units = income // factor  # maximum units so that effective allocation <= income.
+            unit_vars[cat] = model.NewIntVar(0, max_units, f"{cat}_units")
+            
+            # Effective dollar allocation for this category.
+            alloc_vars[cat] = model.NewIntVar(0, income, f"{cat}_allocation")
+            model.Add(alloc_vars[cat] == unit_vars[cat] * factor)
+            
+            # Compute deviation from the current allocation (in dollars).
+            current_val = current_allocations.get(cat, 0)
+            dev = model.NewIntVar(-income, income, f"dev_{cat}")
+            model.Add(dev == alloc_vars[cat] - current_val)
+            
+            # Compute quadratic loss for the deviation.
+            quad = model.NewIntVar(0, income**2, f"quad_{cat}")
+            model.AddMultiplicationEquality(quad, [dev, dev])
+            quad_vars[cat] = quad
         
-        # Compute quadratic loss for the deviation.
-        quad = model.NewIntVar(0, income**2, f"quad_{cat}")
-        model.AddMultiplicationEquality(quad, [dev, dev])
-        quad_vars[cat] = quad
+        # --- Budget Constraints ---
+        # For example, we enforce that the sum of the effective allocations for the needs categories equals total_needs.
+        model.Add(sum(alloc_vars[cat] for cat in NEEDS) == alloc_vars['total_needs'])
         
-        # Multiply by the weight for this category.
-        weighted_term = weights[cat] * quad
-        weighted_quad_terms.append(weighted_term)
-    
-    # --- Budget Constraints ---
-    # For example, we enforce that the sum of the effective allocations for the needs categories equals total_needs.
-    model.Add(sum(alloc_vars[cat] for cat in ['transport_expenditure', 'food_expenditure', 'housing_expenditure', 'insurance_expenditure', 'other_needs_expenditure'])
-              == alloc_vars['total_needs'])
-    
-    # Total allocation constraint: total_needs + total_wants + savings must equal the total income.
-    model.Add(sum(alloc_vars[cat] for cat in ['total_needs', 'total_wants', 'monthly_savings']) == income)
-    
-    # Hard constraints (adjust these bounds as needed):
-    model.Add(alloc_vars['monthly_savings'] >= int(0.2 * income))
-    model.Add(alloc_vars['total_needs'] <= int(0.5 * income))
-    model.Add(alloc_vars['total_wants'] <= int(0.3 * income))
-    
-    # --- Objective: minimize total weighted quadratic loss ---
-    model.Minimize(sum(weighted_quad_terms))
-    
-    # Solve the model.
-    solver = cp_model.CpSolver()
-    status = solver.Solve(model)
-    
-    if status in (cp_model.OPTIMAL, cp_model.FEASIBLE):
-        # Extract effective allocations (dollar amounts).
-        result = {cat: solver.Value(alloc_vars[cat]) for cat in categories}
-        total_weighted_quad_loss = sum(solver.Value(quad_vars[cat]) * weights[cat] for cat in categories)
-        return result, total_weighted_quad_loss
-    else:
+        # Total allocation constraint: total_needs + total_wants + savings must equal the total income.
+        model.Add(sum(alloc_vars[cat] for cat in ['total_needs', 'total_wants', 'monthly_savings']) == income)
+        
+        # Hard constraints (adjust these bounds as needed):
+        model.Add(alloc_vars['monthly_savings'] >= int(MIN_SAVINGS_SHARE * income))
+        model.Add(alloc_vars['total_needs'] <= int(MAX_NEEDS_SHARE * income))
+        model.Add(alloc_vars['total_wants'] <= int(MAX_WANTS_SHARE * income))
+
+        self.model = model
+        self.unit_vars = unit_vars
+        self.alloc_vars = alloc_vars
+        self.quad_vars = quad_vars
+        observe_stage("cp_sat_build", time.perf_counter() - build_start)
+
+    def solve(self, weights, hint=None, time_limit=TIME_LIMIT, num_workers=NUM_WORKERS, on_solution=None, stopper=None):
+        """
+        Solves the model for the weights, see solve_with_cp_sat.
+        """
+        model, categories, factors = self.model, CATEGORIES, FACTORS
+
+        # Start the search from the hint, rounded down to the steps.
+        model.ClearHints()
+        if hint is not None:
+            for cat in categories:
+                units = min(max(int(hint[cat]) // factors[cat], 0), self.income // factors[cat])
+                model.AddHint(self.unit_vars[cat], units)
+                model.AddHint(self.alloc_vars[cat], units * factors[cat])
+        
+        # --- Objective: minimize total weighted quadratic loss ---
+        model.Minimize(sum(weights[cat] * self.quad_vars[cat] for cat in categories))
+        
+        # Solve the model.
+        solver = cp_model.CpSolver()
+        solver.parameters.num_workers = num_workers
+        if time_limit is not None:
+            solver.parameters.max_time_in_seconds = time_limit
+        reporter = SolutionReporter(self.alloc_vars, on_solution) if on_solution is not None else None
+        if stopper is not None and stopper.attach(solver):
+            return None, None
+        with stage_timer("cp_sat_solve"):
+            status = solver.Solve(model, reporter)
+        
+        if status in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+            # Extract effective allocations (dollar amounts).
+            result = {cat: solver.Value(self.alloc_vars[cat]) for cat in categories}
+            total_weighted_quad_loss = sum(solver.Value(self.quad_vars[cat]) * weights[cat] for cat in categories)
+            if on_solution is not None:
+                on_solution(result, total_weighted_quad_loss, int(solver.BestObjectiveBound()), solver.WallTime(), status == cp_model.OPTIMAL)
+            return result, total_weighted_quad_loss
+        else:
+            return None, None
+
+def solve_weight_sweep(income, current, weights_list, solver=SOLVER, time_limit=TIME_LIMIT, num_workers=NUM_WORKERS):
+    """
+    Solves the allocation problem for the same income and current allocations with each of weights_list, returns a
+    list of (result, total_weighted_quad_loss). The CP-SAT model is only built once, for the first weights the
+    fast solver does not handle, and each CP-SAT search starts from the previous solution.
+    """
+    if income <= 0:
+        return [(None, None)] * len(weights_list)
+    solutions = []
+    model = None
+    hint = None
+    for weights in weights_list:
+        solution = None
+        if solver == "fast":
+            with stage_timer("fast_solve"):
+                solution = solve_fast(income, current, weights)
+        if solution is None:
+            if model is None:
+                model = CpSatBudgetModel(income, current)
+            solution = model.solve(weights, hint, time_limit, num_workers)
+        hint = solution[0] or hint
+        solutions.append(solution)
+    return solutions
+
+def solve_fast(income, current_allocations, weights, step=50):
+    """
+    Solves the allocation problem exactly without CP-SAT, returns (result, total_weighted_quad_loss),
+    (None, None) if infeasible, or None if the problem is outside what this solver handles
+    (negative weights, or current allocations so far outside [0, income] that CP-SAT's deviation bounds matter).
+
+    Every allocation is a multiple of 50 dollars: total_needs, total_wants and savings are, and they add up
+    to the income, so the income must be too, and transport is total_needs minus multiples of 50.
+    The loss is separable and convex in the units of each category, with the needs nested in total_needs,
+    so the allocation is optimal once no exchange of one unit between two categories lowers the loss.
+    Starting from the current allocation, the best such exchange is repeated as many times as lowers the
+    loss most (the loss is a quadratic in the number of units moved), until there is none.
+    """
+    if any(w < 0 for w in weights.values()):
+        return None
+    if income % step != 0:
         return None, None
+    units = income // step
+
+    # Bounds (in units) of the categories whose units are exchanged, total_needs is the sum of the needs and
+    # investment does not appear in any constraint.
+    free = NEEDS + ['total_wants', 'monthly_savings']
+    lower = {cat: 0 for cat in free}
+    upper = {cat: units for cat in free}
+    lower['monthly_savings'] = -(-int(MIN_SAVINGS_SHARE * income) // step)
+    upper['total_wants'] = int(MAX_WANTS_SHARE * income) // step
+    needs_upper = int(MAX_NEEDS_SHARE * income) // step
+    # CP-SAT bounds each deviation by the income, which only restricts categories whose current allocation
+    # is outside of [upper bound - income, income].
+    for cat, cat_upper in list(upper.items()) + [('total_needs', needs_upper), ('investment_expenditure', units)]:
+        if not cat_upper * step - income <= current_allocations[cat] <= income:
+            return None
+
+    def loss(cat, cat_units):
+        return weights[cat] * (cat_units * step - current_allocations[cat]) ** 2
+
+    # Start from the current allocation in units, moved into the constraints by taking units out of the
+    # largest categories (or putting the missing units into savings).
+    x = {cat: min(max(round(current_allocations[cat] / step), lower[cat]), upper[cat]) for cat in free}
+
+    def take(cats, amount):
+        for cat in sorted(cats, key=lambda cat: x[cat] - lower[cat], reverse=True):
+            taken = min(amount, x[cat] - lower[cat])
+            x[cat] -= taken
+            amount -= taken
+
+    take(NEEDS, sum(x[cat] for cat in NEEDS) - needs_upper)
+    excess = sum(x.values()) - units
+    if excess > 0:
+        take(free, excess)
+    else:
+        x['monthly_savings'] -= excess
+    needs = sum(x[cat] for cat in NEEDS)
+
+    while True:
+        # Change in loss of moving one unit into and out of each category, and of total_needs going up or down.
+        into = {cat: loss(cat, x[cat] + 1) - loss(cat, x[cat]) for cat in free if x[cat] < upper[cat]}
+        out_of = {cat: loss(cat, x[cat] - 1) - loss(cat, x[cat]) for cat in free if x[cat] > lower[cat]}
+        needs_change = {
+            1: loss('total_needs', needs + 1) - loss('total_needs', needs) if needs < needs_upper else None,
+            0: 0,
+            -1: loss('total_needs', needs - 1) - loss('total_needs', needs),
+        }
+        best, best_move = 0, None
+        for to_cat, into_change in into.items():
+            for from_cat, out_of_change in out_of.items():
+                direction = (to_cat in NEEDS) - (from_cat in NEEDS)
+                if to_cat == from_cat or needs_change[direction] is None:
+                    continue
+                change = into_change + out_of_change + needs_change[direction]
+                if change < best:
+                    best, best_move = change, (to_cat, from_cat, direction)
+        if best_move is None:
+            break
+
+        # Move as many units as minimizes the loss along the exchange (a quadratic in the number of units).
+        to_cat, from_cat, direction = best_move
+        max_units = min(upper[to_cat] - x[to_cat], x[from_cat] - lower[from_cat])
+        if direction == 1:
+            max_units = min(max_units, needs_upper - needs)
+        slope = weights[to_cat] * (x[to_cat] * step - current_allocations[to_cat]) \
+            - weights[from_cat] * (x[from_cat] * step - current_allocations[from_cat]) \
+            + direction * weights['total_needs'] * (needs * step - current_allocations['total_needs'])
+        curvature = (weights[to_cat] + weights[from_cat] + abs(direction) * weights['total_needs']) * step
+        moved = max_units if curvature == 0 else min(max(round(-slope / curvature), 1), max_units)
+        x[to_cat] += moved
+        x[from_cat] -= moved
+        needs += direction * moved
+
+    # Investment is not constrained, the closest multiple of the step to its current allocation is optimal.
+    investment = min(max(round(current_allocations['investment_expenditure'] / step), 0), units)
+    result_units = {**x, 'total_needs': needs, 'investment_expenditure': investment}
+    result = {cat: result_units[cat] * step for cat in CATEGORIES}
+    total_weighted_quad_loss = sum(loss(cat, result_units[cat]) for cat in CATEGORIES)
+    return result, total_weighted_quad_loss
 
 # Example usage:
 # if __name__ == "__main__":
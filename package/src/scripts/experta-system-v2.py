@@ -65,13 +65,36 @@
 #
 
 # %%
-from fastapi import FastAPI
+import asyncio
+import io
+import itertools
+import json
+import threading
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from fastapi import Body, FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 from pydantic import BaseModel
 from experta import KnowledgeEngine, Fact, Rule, MATCH, TEST
-from csp_solver_v4 import optimize_budget_with_weighted_quadratic_loss_custom_units
+import shared_modules  # noqa: F401, makes metrics, offload and profiling importable
+from batch_optimize import get_chunks, optimize_chunk, read_rows
+from budget_rules import RECOMMENDATIONS, analyze_file
+from csp_solver_v4 import CATEGORIES, NUM_WORKERS, SOLVER, SearchStopper, SolutionCache, canonicalize, get_weight_mapping, solve, solve_fast, solve_weight_sweep
+from metrics import add_metrics, stage_timer
+from offload import BoundedProcessPool, PoolSaturated, coalesce_key
+from profiling import add_profiling
+
+# shuts the pool down with the server
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    pool.shutdown()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Allow CORS for your frontend
 app.add_middleware(
@@ -81,6 +104,25 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# profiles requests that ask for it when EZBUDGET_PROFILE_DIR is set (see profiling.py)
+add_profiling(app)
+# latency of each route and of each stage, served at /metrics, added last so it records every response
+add_metrics(app)
+
+# the rule engine and the solver are cpu-bound, they run in worker processes so they do not block the
+# event loop, requests beyond max_pending are turned away with 429 instead of queueing up
+POOL_WORKERS = None # one per cpu
+POOL_MAX_PENDING = None # 4 per worker
+pool = BoundedProcessPool(workers=POOL_WORKERS, max_pending=POOL_MAX_PENDING)
+
+# solutions of recent /optimize-budget requests, the what-if page re-optimizes on every change of a slider
+SOLUTION_CACHE_SIZE = 4096
+solution_cache = SolutionCache(max_entries=SOLUTION_CACHE_SIZE)
+
+# response for requests turned away because the pool is saturated
+def busy_response():
+    return JSONResponse({"status": "error", "error": "Server is busy, please try again later"},
+                        status_code=429, headers={"Retry-After": "1"})
 
 
 class BudgetInput(BaseModel):
@@ -127,6 +169,11 @@ class BudgetAdvisor(KnowledgeEngine):
         super().__init__()
         self.recommendations = []
 
+    # clears the recommendations along with the facts, so an engine can be reused for another budget
+    def reset(self, **kwargs):
+        self.recommendations = []
+        super().reset(**kwargs)
+
     # ---------------- Needs Analysis Rules ----------------
     @Rule(BudgetInfo(owns_car=MATCH.owns_car,
                      transport_expenditure=MATCH.transport),
@@ -134,14 +181,13 @@ class BudgetAdvisor(KnowledgeEngine):
                (not owns_car) and (transport > 150)),
           salience=9)
     def rule_public_transport(self, owns_car, transport):
-        self.recommendations.append("Your transport spendings are above average. Consider taking public transport instead of using private options.")
+        self.recommendations.append(RECOMMENDATIONS["public_transport"])
 
     @Rule(BudgetInfo(insurance_expenditure=MATCH.insurance, monthly_take_home=MATCH.take_home),
           TEST(lambda insurance, take_home: insurance > 0.15 * take_home),
           salience=9)
     def rule_reduce_insurance(self, insurance, take_home):
-        self.recommendations.append("Your spending on insurance is too high! " \
-        "The recommended spending on insurance is maximum 15% of your take home-salary.")
+        self.recommendations.append(RECOMMENDATIONS["reduce_insurance"])
 
     @Rule(BudgetInfo(transport_expenditure=MATCH.transport,
                      food_expenditure=MATCH.food,
@@ -153,22 +199,19 @@ class BudgetAdvisor(KnowledgeEngine):
                (transport + food + housing + insurance + others) > 0.5 * take_home),
           salience=10)
     def rule_reduce_needs(self, transport, food, housing, insurance, others, take_home):
-        self.recommendations.append("Your spending on necessities are too high! " \
-        "The recommended spending on needs is maximum 50% of your take-home salary.")
+        self.recommendations.append(RECOMMENDATIONS["reduce_needs"])
 
     @Rule(BudgetInfo(food_expenditure=MATCH.food, monthly_take_home=MATCH.take_home),
           TEST(lambda food, take_home: food > 0.15 * take_home),
           salience=9)
     def rule_reduce_food(self, food, take_home):
-        self.recommendations.append("Your spending on food are too high! " \
-        "The recommended spending on food is maximum 15% of your take-home salary.")
+        self.recommendations.append(RECOMMENDATIONS["reduce_food"])
 
     @Rule(BudgetInfo(housing_expenditure=MATCH.housing, monthly_take_home=MATCH.take_home),
           TEST(lambda housing, take_home: housing > 0.35 * take_home),
           salience=9)
     def rule_housing_alternatives(self, housing, take_home):
-        self.recommendations.append("You may want to consider looking for alternative housing options " \
-        "as housing costs are over 35% of your take-home salary.")
+        self.recommendations.append(RECOMMENDATIONS["housing_alternatives"])
 
     # ---------------- Wants Analysis Rule ----------------
     @Rule(BudgetInfo(transport_expenditure=MATCH.transport,
@@ -182,8 +225,7 @@ class BudgetAdvisor(KnowledgeEngine):
                (take_home - savings - transport - food - housing - insurance - others) > 0.3 * take_home),
           salience=8)
     def rule_reduce_wants(self, transport, food, housing, insurance, others, savings, take_home):
-        self.recommendations.append("Your spending on wants are too high! " \
-        "The recommended spending on wants is maximum 30% of your take-home salary.")
+        self.recommendations.append(RECOMMENDATIONS["reduce_wants"])
 
     # ---------------- Savings Analysis Rules ----------------
     @Rule(BudgetInfo(investment_expenditure=MATCH.invest,
@@ -195,89 +237,463 @@ class BudgetAdvisor(KnowledgeEngine):
           salience=6)
     def rule_investment_recommendations(self, age, number_of_kids, buy_home):
         if age < 65:
-            self.recommendations.append("Consider investing in long-term plans (e.g. ETFs) for retirement.")
+            self.recommendations.append(RECOMMENDATIONS["invest_retirement"])
         if number_of_kids > 0:
-            self.recommendations.append("Consider short-term investment plans for your kids' tertiary education.")
+            self.recommendations.append(RECOMMENDATIONS["invest_education"])
         if buy_home:
-            self.recommendations.append("Consider short-term investment plans to help with home loan repayment.")
+            self.recommendations.append(RECOMMENDATIONS["invest_home_loan"])
 
     @Rule(BudgetInfo(monthly_savings=MATCH.savings, monthly_take_home=MATCH.take_home),
           TEST(lambda savings, take_home: savings < 0.2 * take_home),
           salience=7)
     def rule_increase_savings(self, savings, take_home):
-        self.recommendations.append("Your savings are too low! You are recommended to save 20% of your take-home salary. " \
-        "You can increase your monthly savings by reducing spending on needs or wants.")
+        self.recommendations.append(RECOMMENDATIONS["increase_savings"])
 
     # ---------------- Emergency Funds Analysis Rules ----------------
     @Rule(BudgetInfo(emergency_funds=MATCH.funds, monthly_take_home=MATCH.take_home, monthly_savings=MATCH.savings),
           TEST(lambda funds, take_home, savings: funds < 3 * (take_home - savings)),
           salience=5)
     def rule_emergency_funds_low(self, funds, take_home, savings):
-        self.recommendations.append("Financial experts recommend maintaining an emergency fund covering 3-6 months of your monthly expenses. " \
-        "Currently, your savings fall short of the 3-month minimum. " \
-        "To avoid financial stress during unexpected events, please consider increasing your savings as soon as possible.")
+        self.recommendations.append(RECOMMENDATIONS["emergency_funds_low"])
 
     @Rule(BudgetInfo(emergency_funds=MATCH.funds, monthly_take_home=MATCH.take_home, monthly_savings=MATCH.savings),
           TEST(lambda funds, take_home, savings: funds > 3 * (take_home - savings) and funds < 6 * (take_home - savings)),
           salience=5)
     def rule_emergency_funds_medium(self, funds, take_home, savings):
-        self.recommendations.append("Financial experts recommend maintaining an emergency fund covering 3-6 months of your monthly expenses. " \
-        "Build up your emergency funds to cover at least 6 months of your current expenses.")
+        self.recommendations.append(RECOMMENDATIONS["emergency_funds_medium"])
+
+# rule engines that were already built (building one takes longer than running it), reset and reused for each
+# budget, each worker process has its own
+engines = []
+engines_lock = threading.Lock()
+
+# runs the rule engine on a budget (a dict with the fields of BudgetInput), returns its recommendations
+def advise(budget):
+    with engines_lock:
+        engine = engines.pop() if engines else None
+    if engine is None:
+        with stage_timer("rule_engine_build"):
+            engine = BudgetAdvisor()
+    with stage_timer("rule_engine_run"):
+        engine.reset()
+        engine.declare(BudgetInfo(**budget))
+        engine.run()
+    recommendations = engine.recommendations
+    with engines_lock:
+        engines.append(engine)
+    return recommendations
+
+# fields of BudgetInput the rules read, the advice of budgets that only differ in the others is the same
+ADVICE_FIELDS = [
+    "age", "number_of_kids", "monthly_take_home", "planning_to_buy_home", "owns_car", "transport_expenditure",
+    "food_expenditure", "housing_expenditure", "insurance_expenditure", "other_needs_expenditure", "emergency_funds",
+    "investment_expenditure", "monthly_savings",
+]
+ADVICE_CACHE_SIZE = 10000
+
+
+# least recently used cache of the recommendations of budgets, keyed by the fields the rules read, so analyzing
+# a budget again does not run the rule engine
+class AdviceCache():
+    def __init__(self, max_entries=ADVICE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> recommendations
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # key of a budget (a dict with the fields of BudgetInput)
+    def get_key(self, budget):
+        return tuple(float(budget[field]) for field in ADVICE_FIELDS)
+
+    # returns the cached recommendations (marking them as recently used), or None if they are not cached
+    def get(self, key):
+        recommendations = self.entries.get(key)
+        if recommendations is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return recommendations
+
+    def add(self, key, recommendations):
+        self.entries[key] = recommendations
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    # cache statistics
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+advice_cache = AdviceCache()
 
 @app.post("/analyze-budget")
 async def analyze_budget(budget_data: BudgetInput):
-    engine = BudgetAdvisor()
-    engine.reset()
-    engine.declare(BudgetInfo(**budget_data.dict()))
-    engine.run()
+    budget = budget_data.dict()
+    key = advice_cache.get_key(budget)
+    recommendations = advice_cache.get(key)
+    if recommendations is None:
+        try:
+            recommendations = await pool.run(coalesce_key("analyze", key), advise, budget)
+        except PoolSaturated:
+            return busy_response()
+        advice_cache.add(key, recommendations)
     
     return {
-        "recommendations": engine.recommendations,
+        "recommendations": list(recommendations),
         "status": "success"
     }
 
-@app.post("/optimize-budget")
-async def optimize_budget(budget_data: BudgetInput, weights: dict = None):
+@app.get("/analyze-budget/cache")
+async def analyze_budget_cache():
+    return {
+        "cache": advice_cache.stats(),
+        "pool": pool.stats()
+    }
+
+# CP-SAT search parameters a request can set, see TIME_LIMIT and NUM_WORKERS in csp_solver_v4.py
+MAX_NUM_WORKERS = 16
+STREAM_TIME_LIMIT = 10.0 # time limit of /optimize-budget/stream when the request does not set one
+MAX_STREAM_TIME_LIMIT = 60.0 # longer time limits of /optimize-budget/stream are cut to this
+MAX_STREAMS = 4 # streamed searches running at a time, further requests get 429
+
+# returns the error response for invalid search parameters, or None if they are valid
+def check_search_params(time_limit, num_workers):
+    if time_limit is not None and time_limit <= 0:
+        return JSONResponse({"status": "error", "error": "time_limit must be positive"}, status_code=400)
+    if num_workers is not None and not 0 <= num_workers <= MAX_NUM_WORKERS:
+        return JSONResponse({"status": "error", "error": f"num_workers must be between 0 and {MAX_NUM_WORKERS}"}, status_code=400)
+    return None
+
+# returns the cache key, income, current allocations and weights of the optimization of a budget
+# with round_amounts, the amounts are rounded to the steps they are allocated in (see canonicalize)
+def get_problem(budget_data, weights, round_amounts=False):
     # Convert all float fields to integers
     budget_dict = budget_data.dict()
     for key, value in budget_dict.items():
         if isinstance(value, float):
             budget_dict[key] = int(value)
     
-    # Default weights if none provided
-    if weights is None:
-        weights = {
-            'transport': 1,
-            'food': 1,
-            'housing': 1,
-            'insurance': 1,
-            'other_needs': 1,
-            'savings': 1,
-            'investments': 1
-        }
+    # Default weights if none provided (all 1), converted to integers
+    weight_mapping = get_weight_mapping(weights)
     
-    # Convert weights to integers if needed
-    weight_mapping = {
-        'transport_expenditure': int(weights['transport']),
-        'food_expenditure': int(weights['food']),
-        'housing_expenditure': int(weights['housing']),
-        'insurance_expenditure': int(weights['insurance']),
-        'other_needs_expenditure': int(weights['other_needs']),
-        'monthly_savings': int(weights['savings']),
-        'investment_expenditure': int(weights['investments'])
-    }
-    
-    # Run optimization with custom weights
-    optimization_result, _ = optimize_budget_with_weighted_quadratic_loss_custom_units(
-        budget_dict,
-        custom_weights=weight_mapping
-    )
+    key, current, weights = canonicalize(budget_dict, weight_mapping, round_amounts=round_amounts)
+    return key, budget_dict["monthly_take_home"], current, weights
+
+# looks up the solution in the cache, or solves it with the fast solver, returns None if it needs CP-SAT
+def get_cached_or_fast_solution(key, income, current, weights):
+    solution = solution_cache.get(key)
+    if solution is None and SOLVER == "fast" and income > 0:
+        # the fast solver takes microseconds so it runs here
+        with stage_timer("fast_solve"):
+            solution = solve_fast(income, current, weights)
+        if solution is not None:
+            solution_cache.add(key, solution)
+    return solution
+
+@app.post("/optimize-budget")
+async def optimize_budget(budget_data: BudgetInput, weights: dict = None, time_limit: float = None, num_workers: int = None,
+                          round_amounts: bool = False):
+    """
+    time_limit (seconds) and num_workers are CP-SAT search parameters, with a time limit the best solution
+    found within it is returned.
+    With round_amounts, the current amounts are rounded to the steps they are allocated in before solving, so
+    small changes of a slider find the solution in the cache (the result may differ from the exact optimum).
+    """
+    error = check_search_params(time_limit, num_workers)
+    if error is not None:
+        return error
+    key, income, current, weights = get_problem(budget_data, weights, round_amounts)
+    solution = get_cached_or_fast_solution(key, income, current, weights)
+    if solution is None:
+        # problems the fast solver does not handle are solved with CP-SAT in the pool, starting from the
+        # cached solution of the most similar budget
+        num_workers = NUM_WORKERS if num_workers is None else num_workers
+        try:
+            solution = await pool.run(
+                coalesce_key("optimize", key, time_limit, num_workers),
+                solve,
+                income,
+                current,
+                weights,
+                SOLVER,
+                solution_cache.nearest(key),
+                time_limit,
+                num_workers
+            )
+        except PoolSaturated:
+            return busy_response()
+        # solutions cut short by the time limit may not be optimal
+        if time_limit is None:
+            solution_cache.add(key, solution)
+    optimization_result, _ = solution
     
     return {
         "optimization": optimization_result,
         "status": "success"
     }
 
+running_streams = 0
+
+@app.post("/optimize-budget/stream")
+async def optimize_budget_stream(budget_data: BudgetInput, weights: dict = None, time_limit: float = STREAM_TIME_LIMIT, num_workers: int = None):
+    """
+    Same as /optimize-budget, but streams ndjson: a line with status "solution" for each improving solution as the
+    search finds it (optimization, loss, bound on the optimal loss, seconds, optimal), then a final line with
+    status "success" and the best solution (optimization null if there is none).
+    time_limit is at most MAX_STREAM_TIME_LIMIT, the search is stopped if the client disconnects.
+    """
+    global running_streams
+    error = check_search_params(time_limit, num_workers)
+    if error is not None:
+        return error
+    if running_streams >= MAX_STREAMS:
+        return busy_response()
+    key, income, current, weights = get_problem(budget_data, weights)
+    num_workers = NUM_WORKERS if num_workers is None else num_workers
+    time_limit = min(time_limit, MAX_STREAM_TIME_LIMIT)
+    loop = asyncio.get_running_loop()
+    solutions = asyncio.Queue()
+    stopper = SearchStopper()
+
+    # the slot is taken before the response is returned, so concurrent requests see it, and released once when
+    # the stream ends, or after the response if the stream never started
+    running_streams += 1
+    released = False
+    def release():
+        global running_streams
+        nonlocal released
+        if not released:
+            released = True
+            running_streams -= 1
+
+    def on_solution(result, loss, bound, seconds, optimal):
+        loop.call_soon_threadsafe(solutions.put_nowait, {
+            "status": "solution", "optimization": result, "loss": loss, "bound": bound, "seconds": seconds, "optimal": optimal
+        })
+
+    async def search():
+        solution = get_cached_or_fast_solution(key, income, current, weights)
+        if solution is not None:
+            if solution[0] is not None:
+                on_solution(solution[0], solution[1], solution[1], 0.0, True)
+            return solution
+        # CP-SAT releases the GIL while searching, so it runs in a thread that reports its solutions to this loop
+        return await loop.run_in_executor(
+            None, solve, income, current, weights, SOLVER, solution_cache.nearest(key), time_limit, num_workers, on_solution, stopper
+        )
+
+    async def stream_solutions():
+        try:
+            task = asyncio.ensure_future(search())
+            last = None
+            while not (task.done() and solutions.empty()):
+                getter = asyncio.ensure_future(solutions.get())
+                await asyncio.wait([getter, task], return_when=asyncio.FIRST_COMPLETED)
+                if not getter.done():
+                    getter.cancel()
+                    continue
+                last = getter.result()
+                yield json.dumps(last) + "\n"
+            optimization_result, loss = await task
+            if last is not None and last["optimal"]:
+                solution_cache.add(key, (optimization_result, loss))
+            yield json.dumps({
+                "status": "success",
+                "optimization": optimization_result,
+                "loss": loss,
+                "optimal": last is not None and last["optimal"],
+            }) + "\n"
+        finally:
+            # the client may be gone (the stream is then cancelled), its search must not keep running
+            stopper.stop()
+            release()
+
+    return StreamingResponse(stream_solutions(), media_type="application/x-ndjson", background=BackgroundTask(release))
+
+@app.get("/optimize-budget/cache")
+async def optimize_budget_cache():
+    return {
+        "cache": solution_cache.stats(),
+        "pool": pool.stats()
+    }
+
+# runs fn(*args) in the pool, waiting while the pool is saturated rather than failing, for the chunks of
+# batch requests, which leave room for other requests this way
+async def run_when_free(fn, *args):
+    while True:
+        try:
+            return await pool.run(None, fn, *args)
+        except PoolSaturated:
+            await asyncio.sleep(0.05)
+
+# runs fn(*args) in the pool for each args of args_list, one per worker at a time, and yields the results
+# in order as soon as they are done
+# args_list is iterated in the threadpool, so producing its items (e.g. parsing the rows of an uploaded file)
+# does not block the event loop
+async def map_chunks(fn, args_list):
+    pending = deque()
+    async for args in iterate_in_threadpool(args_list):
+        pending.append(asyncio.ensure_future(run_when_free(fn, *args)))
+        if len(pending) >= pool.workers:
+            yield await pending.popleft()
+    while pending:
+        yield await pending.popleft()
+
+# content type of a batch -> format
+BATCH_FORMATS = {
+    "text/csv": "csv",
+    "application/x-ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+    "application/json": "ndjson",
+    "application/vnd.apache.parquet": "parquet",
+}
+
+MAX_BATCH_BYTES = 64 * 2**20 # largest body of a batch request
+
+# reads the body of a batch request, returns None if it is larger than max_bytes (checked against Content-Length
+# before reading, and while reading since it may be missing)
+async def read_batch_body(request, max_bytes=MAX_BATCH_BYTES):
+    content_length = request.headers.get("content-length")
+    if content_length is not None and content_length.isdigit() and int(content_length) > max_bytes:
+        return None
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes:
+            return None
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+# response to a batch request whose body is too large
+def too_large_response():
+    return JSONResponse({"status": "error", "error": f"Body must be at most {MAX_BATCH_BYTES} bytes"}, status_code=413)
+
+# returns the format of a batch request: the format parameter if given, otherwise taken from the Content-Type,
+# None if it is not csv, ndjson or parquet
+def get_batch_format(request, format=None):
+    format = format or BATCH_FORMATS.get(request.headers.get("content-type", "").split(";")[0].strip())
+    return format if format in ("csv", "ndjson", "parquet") else None
+
+@app.post("/analyze-budget/batch")
+async def analyze_budget_batch(request: Request, format: str = None):
+    """
+    Analyze many budgets at once with the rules of BudgetAdvisor evaluated over the whole table (see budget_rules.py).
+    The body is a csv, ndjson or parquet file of BudgetInput rows (the format is taken from the Content-Type if not
+    given), returns ndjson with the status and recommendation codes of each row, in input order.
+    The body is at most MAX_BATCH_BYTES.
+    """
+    format = get_batch_format(request, format)
+    if format is None:
+        return JSONResponse({"status": "error", "error": "Format must be csv, ndjson or parquet"}, status_code=400)
+    body = await read_batch_body(request)
+    if body is None:
+        return too_large_response()
+    try:
+        results = await run_when_free(analyze_file, body, format)
+    except ValueError as e:
+        return JSONResponse({"status": "error", "error": str(e)}, status_code=400)
+    return Response(results, media_type="application/x-ndjson")
+
+@app.post("/optimize-budget/batch")
+async def optimize_budget_batch(request: Request, format: str = None, weights: str = None):
+    """
+    Optimize many budgets at once. The body is a csv, ndjson or parquet file of BudgetInput rows (the format is taken
+    from the Content-Type if not given), weights is json like the weights of /optimize-budget.
+    Results are streamed back as ndjson in input order, with the status and solve time of each row.
+    The body is at most MAX_BATCH_BYTES.
+    """
+    format = get_batch_format(request, format)
+    if format is None:
+        return JSONResponse({"status": "error", "error": "Format must be csv, ndjson or parquet"}, status_code=400)
+    try:
+        weight_mapping = get_weight_mapping(json.loads(weights) if weights else None)
+    except (ValueError, KeyError, TypeError):
+        return JSONResponse({"status": "error", "error": "Invalid weights"}, status_code=400)
+    body = await read_batch_body(request)
+    if body is None:
+        return too_large_response()
+    # the format and its dependencies are checked before the response starts, malformed rows are reported
+    # in the results, the rows are parsed in the threadpool as they are needed (see map_chunks)
+    try:
+        rows = await run_in_threadpool(read_rows, io.BytesIO(body), format)
+    except ValueError as e:
+        return JSONResponse({"status": "error", "error": str(e)}, status_code=400)
+
+    async def stream_results():
+        async for results in map_chunks(optimize_chunk, ((chunk, weight_mapping) for chunk in get_chunks(rows))):
+            for result in results:
+                yield json.dumps(result) + "\n"
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+MAX_SWEEP = 1000 # weight settings of a sweep
+SWEEP_CHUNK_SIZE = 20 # weight settings solved per task sent to the pool
+
+# helper function, whether deviations a are at least as small as deviations b everywhere and smaller somewhere
+def dominates(a, b):
+    return all(x <= y for x, y in zip(a, b)) and a != b
+
+@app.post("/optimize-budget/sweep")
+async def optimize_budget_sweep(budget_data: BudgetInput, weights_grid: dict = None, weights_list: list = Body(None),
+                                time_limit: float = None, num_workers: int = None):
+    """
+    Optimize a budget for many weights at once: every combination of weights_grid (weight name -> list of values)
+    and/or each weights of weights_list, missing weights are 1.
+    Streams ndjson: a line with status "solution" for each weights, in order, with its optimization, loss and
+    deviation of each category from the current allocation, then a final line with status "success" and the indices
+    of the Pareto frontier (the solutions whose deviations no other solution improves on in every category).
+    """
+    error = check_search_params(time_limit, num_workers)
+    if error is not None:
+        return error
+    weights_list = list(weights_list or [])
+    if weights_grid:
+        names = list(weights_grid)
+        weights_list += [dict(zip(names, values)) for values in itertools.product(*weights_grid.values())]
+    if not weights_list or len(weights_list) > MAX_SWEEP:
+        return JSONResponse({"status": "error", "error": f"Between 1 and {MAX_SWEEP} weights must be given"}, status_code=400)
+    try:
+        problems = [get_problem(budget_data, weights) for weights in weights_list]
+    except (ValueError, TypeError, AttributeError):
+        return JSONResponse({"status": "error", "error": "Invalid weights"}, status_code=400)
+    _, income, current, _ = problems[0]
+    num_workers = NUM_WORKERS if num_workers is None else num_workers
+    chunks = [problems[i:i + SWEEP_CHUNK_SIZE] for i in range(0, len(problems), SWEEP_CHUNK_SIZE)]
+
+    async def stream_solutions():
+        deviations = {}
+        index = 0
+        async for solutions in map_chunks(solve_weight_sweep, (
+            (income, current, [weights for _, _, _, weights in chunk], SOLVER, time_limit, num_workers) for chunk in chunks
+        )):
+            for solution in solutions:
+                key = problems[index][0]
+                optimization_result, loss = solution
+                # solutions cut short by the time limit may not be optimal
+                if time_limit is None:
+                    solution_cache.add(key, solution)
+                line = {"status": "solution", "index": index, "weights": weights_list[index], "optimization": optimization_result, "loss": loss}
+                if optimization_result is not None:
+                    line["deviations"] = {cat: optimization_result[cat] - current[cat] for cat in CATEGORIES}
+                    deviations[index] = [abs(d) for d in line["deviations"].values()]
+                yield json.dumps(line) + "\n"
+                index += 1
+        pareto = [i for i, d in deviations.items() if not any(dominates(other, d) for other in deviations.values())]
+        yield json.dumps({"status": "success", "pareto": pareto}) + "\n"
+
+    return StreamingResponse(stream_solutions(), media_type="application/x-ndjson")
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8001)
@@ -0,0 +1,8 @@
+# the modules shared by both services (metrics.py, offload.py and profiling.py) are in the shared folder at the
+# root of the repository, importing this module before them makes them importable
+import os
+import sys
+
+SHARED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "shared")
+if SHARED_DIR not in sys.path:
+    sys.path.append(SHARED_DIR)
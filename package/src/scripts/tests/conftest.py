@@ -0,0 +1,62 @@
+import importlib
+import os
+import sys
+
+import numpy as np
+import pytest
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SCRIPTS_DIR)
+
+
+# experta-system-v2.py (not a valid module name)
+@pytest.fixture(scope="session")
+def expert_system():
+    return importlib.import_module("experta-system-v2")
+
+
+# seeded budgets with the fields of BudgetInput, most amounts at a threshold of the rules (see budget_rules.py),
+# one dollar below or above it, or anywhere
+@pytest.fixture(scope="session")
+def budgets():
+    return make_budgets(300)
+
+
+def make_budgets(n, seed=0):
+    rng = np.random.default_rng(seed)
+
+    def near(threshold):
+        if rng.random() < 0.75:
+            return max(0.0, float(threshold + rng.choice([-1, 0, 0, 1])))
+        return float(rng.uniform(0, 2 * max(threshold, 1)))
+
+    budgets = []
+    for _ in range(n):
+        take_home = float(rng.integers(20, 150) * 100)
+        transport = near(150)
+        food = near(0.15 * take_home)
+        housing = near(0.35 * take_home)
+        insurance = near(0.15 * take_home)
+        others = near(0.5 * take_home - transport - food - housing - insurance)
+        needs = transport + food + housing + insurance + others
+        # at the savings threshold, or where the rest of the take-home (the wants) is at its threshold
+        savings = near(0.2 * take_home) if rng.random() < 0.5 else near(take_home - needs - 0.3 * take_home)
+        expenses = take_home - savings
+        budgets.append({
+            "age": int(rng.choice([64, 65, 66, rng.integers(21, 90)])),
+            "number_of_kids": int(rng.integers(0, 3)),
+            "monthly_take_home": take_home,
+            "planning_to_buy_home": bool(rng.random() < 0.5),
+            "repaying_home_loans": bool(rng.random() < 0.5),
+            "supporting_aged_parents": bool(rng.random() < 0.5),
+            "owns_car": bool(rng.random() < 0.5),
+            "transport_expenditure": transport,
+            "food_expenditure": food,
+            "housing_expenditure": housing,
+            "insurance_expenditure": insurance,
+            "other_needs_expenditure": others,
+            "emergency_funds": near(3 * expenses) if rng.random() < 0.5 else near(6 * expenses),
+            "investment_expenditure": near(0.1 * take_home),
+            "monthly_savings": savings,
+        })
+    return budgets
@@ -0,0 +1,6 @@
+from budget_rules import find_differences
+
+
+def test_rules_match_budget_advisor(expert_system, budgets):
+    differences = find_differences(expert_system.advise, budgets)
+    assert not differences, f"budget_rules differs from BudgetAdvisor on {len(differences)} budgets, e.g. {differences[0]}"
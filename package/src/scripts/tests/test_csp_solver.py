@@ -0,0 +1,45 @@
+import math
+
+import numpy as np
+
+from csp_solver_v4 import (CATEGORIES, FACTORS, MAX_NEEDS_SHARE, MAX_WANTS_SHARE, MIN_SAVINGS_SHARE, NEEDS, WEIGHT_NAMES,
+                           get_current_and_weights, solve_fast, solve_with_cp_sat)
+
+
+# seeded problems: a budget with, half of the time, custom weights (by category, as get_weight_mapping gives them)
+def make_problems(budgets, seed=0):
+    rng = np.random.default_rng(seed)
+    for budget in budgets:
+        custom_weights = None
+        if rng.random() < 0.5:
+            custom_weights = {cat: int(rng.integers(1, 6)) for cat in WEIGHT_NAMES.values()}
+        yield budget, custom_weights
+
+
+def check_feasible(income, result):
+    assert all(result[cat] % FACTORS[cat] == 0 and 0 <= result[cat] <= income for cat in CATEGORIES)
+    assert sum(result[cat] for cat in NEEDS) == result["total_needs"]
+    assert result["total_needs"] + result["total_wants"] + result["monthly_savings"] == income
+    assert result["monthly_savings"] >= int(MIN_SAVINGS_SHARE * income)
+    assert result["total_needs"] <= int(MAX_NEEDS_SHARE * income)
+    assert result["total_wants"] <= int(MAX_WANTS_SHARE * income)
+
+
+def test_fast_solver_matches_cp_sat(budgets):
+    solved = 0
+    for budget, custom_weights in make_problems(budgets[:60]):
+        income = int(budget["monthly_take_home"])
+        current, weights = get_current_and_weights(budget, custom_weights)
+        solution = solve_fast(income, current, weights)
+        if solution is None:
+            continue  # outside what the fast solver handles
+        reference = solve_with_cp_sat(income, current, weights)
+        if reference[0] is None:
+            assert solution == (None, None)
+            continue
+        result, loss = solution
+        check_feasible(income, result)
+        assert loss == sum(weights[cat] * (result[cat] - current[cat]) ** 2 for cat in CATEGORIES)
+        assert math.isclose(loss, reference[1], rel_tol=1e-9), (budget, custom_weights)
+        solved += 1
+    assert solved > 40
@@ -0,0 +1,124 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds (in seconds) of the histogram buckets, from 10 microseconds to 30 seconds
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+# cumulative histogram of durations for each combination of label values
+class Histogram():
+    def __init__(self, name, description, label_names, buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {} # label values -> [count per bucket, sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    # renders the histogram in the prometheus text format
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_values, (bucket_counts, total, count) in sorted(self.series.items()):
+                labels = ",".join(f'{k}="{escape(v)}"' for k, v in zip(self.label_names, label_values))
+                sep = "," if labels else ""
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append(f'{self.name}_bucket{{{labels}{sep}le="{bound}"}} {bucket_count}')
+                lines.append(f'{self.name}_bucket{{{labels}{sep}le="+Inf"}} {count}')
+                lines.append(f"{self.name}_sum{{{labels}}} {total}")
+                lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return "\n".join(lines)
+
+
+# helper function, escapes a label value for the prometheus text format
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+request_duration = Histogram(
+    "ezbudget_request_duration_seconds", "Time spent handling requests.", ("method", "route", "status"))
+stage_duration = Histogram(
+    "ezbudget_stage_duration_seconds", "Time spent in each stage of the computations.", ("stage",))
+
+
+# stage timings collected by collect_stages in the current thread, None when not collecting
+_collected = threading.local()
+
+
+# records that a run of the stage took seconds
+def observe_stage(stage, seconds):
+    observations = getattr(_collected, "observations", None)
+    if observations is not None:
+        observations.append((stage, seconds))
+    else:
+        stage_duration.observe(seconds, stage)
+
+
+# times the code in the with block as one run of the stage
+@contextmanager
+def stage_timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+# collects the stages timed in the with block into a list of (stage, seconds) instead of recording them,
+# used in worker processes so the timings can be sent back and recorded in the server process
+@contextmanager
+def collect_stages():
+    observations = []
+    _collected.observations = observations
+    try:
+        yield observations
+    finally:
+        _collected.observations = None
+
+
+# adds a middleware to the fastapi app recording the latency of every request by route, and serves
+# the recorded metrics at /metrics in the prometheus text format
+def add_metrics(app):
+    from fastapi import Request
+    from fastapi.responses import PlainTextResponse
+    from starlette.routing import Match
+
+    # helper function, route template of a request that did not reach the router (e.g. answered by a middleware)
+    def match_route(scope):
+        for route in app.router.routes:
+            if route.matches(scope)[0] == Match.FULL:
+                return route.path
+        return "unmatched"
+
+    @app.middleware("http")
+    async def record_request_duration(request: Request, call_next):
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            # label by route template (e.g. /predict/{num_mths}) rather than by path to bound the number of series
+            route = request.scope.get("route")
+            path = route.path if route is not None else match_route(request.scope)
+            request_duration.observe(time.perf_counter() - start, request.method, path, str(status))
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    def read_metrics():
+        """
+        Latency of each route and time spent in each stage, in the prometheus text format.
+        """
+        return request_duration.render() + "\n" + stage_duration.render() + "\n"
@@ -0,0 +1,118 @@
+import asyncio
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from metrics import collect_stages, observe_stage
+from profiling import current_profile, profile_call
+
+
+# raised when a pool already has as many computations running or queued as it accepts
+class PoolSaturated(Exception):
+    pass
+
+
+# runs fn in a worker process, sending the stage timings recorded there back with the result, and the
+# stacks sampled while it ran if it is profiled (None otherwise)
+def _run_collecting_stages(fn, args, profile=False):
+    stacks = None
+    with collect_stages() as observations:
+        if profile:
+            result, stacks = profile_call(fn, args)
+        else:
+            result = fn(*args)
+    return result, observations, stacks
+
+
+# helper function, key identifying a computation by its (json serializable) arguments, so that
+# identical requests share one computation
+def coalesce_key(*parts):
+    return json.dumps(parts, sort_keys=True, default=str)
+
+
+# runs cpu-bound functions in a pool of worker processes so they do not block the event loop
+# at most max_pending computations are running or queued at a time, further ones are rejected with
+# PoolSaturated (so the queue, and with it the latency, stays bounded), and a computation with the same key
+# as one that is still running is not started again, the caller waits for the running one instead
+# if a worker process dies (e.g. killed for using too much memory), the executor cannot run anything anymore,
+# it is then replaced by a new one and the computations that were running are run again once
+# must only be used from the event loop thread
+class BoundedProcessPool():
+    def __init__(self, workers=None, max_pending=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 4
+        self.executor = None # started on first use
+        self.in_flight = {} # key -> future of the running computation
+        self.pending = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.restarts = 0
+
+    # runs fn(*args) in a worker process and returns its result, fn and args must be picklable
+    # if the request is profiled (see profiling.py), so is the computation, unless it is shared with another request
+    # a computation whose worker process died is run once more before BrokenProcessPool is raised
+    async def run(self, key, fn, *args):
+        profile = current_profile.get()
+        for attempt in range(2):
+            future = self.in_flight.get(key) if key is not None else None
+            if future is not None:
+                self.coalesced += 1
+            else:
+                if self.pending >= self.max_pending:
+                    self.rejected += 1
+                    raise PoolSaturated()
+                future = self.submit(fn, args, profile is not None)
+                self.pending += 1
+                future.add_done_callback(lambda f: self.finish(key, f))
+                if key is not None:
+                    self.in_flight[key] = future
+            try:
+                # shielded so that a caller giving up (e.g. the client disconnected) does not cancel the
+                # computation for the other callers waiting on it
+                result, _, stacks = await asyncio.shield(future)
+                break
+            except BrokenProcessPool:
+                if attempt == 1:
+                    raise
+        if profile is not None and stacks:
+            profile.add_stacks(stacks, "worker process")
+        return result
+
+    # helper function, starts a computation in the executor, replacing the executor first if it is broken
+    # (a submission to a broken executor fails right away, its running computations fail with BrokenProcessPool)
+    def submit(self, fn, args, profile):
+        loop = asyncio.get_running_loop()
+        if self.executor is not None:
+            try:
+                return loop.run_in_executor(self.executor, _run_collecting_stages, fn, args, profile)
+            except BrokenProcessPool:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.restarts += 1
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        return loop.run_in_executor(self.executor, _run_collecting_stages, fn, args, profile)
+
+    # helper function, called once a computation is done
+    def finish(self, key, future):
+        self.pending -= 1
+        if key is not None and self.in_flight.get(key) is future:
+            del self.in_flight[key]
+        if not future.cancelled() and future.exception() is None:
+            for stage, seconds in future.result()[1]:
+                observe_stage(stage, seconds)
+
+    # pool statistics
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "coalesced": self.coalesced,
+            "rejected": self.rejected,
+            "restarts": self.restarts,
+        }
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,210 @@
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+SAMPLE_INTERVAL = 0.001 # seconds between two stack samples (in the server, python code holding the gil is sampled at most every sys.getswitchinterval())
+
+# profiling is only set up when EZBUDGET_PROFILE_DIR is set, requests are then profiled if they have the
+# X-Profile header (and the X-Admin-Token header if EZBUDGET_ADMIN_TOKEN is set), or at random with the
+# probability EZBUDGET_PROFILE_SAMPLE_RATE
+PROFILE_DIR = os.environ.get("EZBUDGET_PROFILE_DIR")
+PROFILE_SAMPLE_RATE = float(os.environ.get("EZBUDGET_PROFILE_SAMPLE_RATE", "0"))
+ADMIN_TOKEN = os.environ.get("EZBUDGET_ADMIN_TOKEN")
+
+# the StackSampler of the request being handled, if it is profiled (worker processes of a BoundedProcessPool
+# profile the computations of such requests and send their stacks back to it)
+current_profile = contextvars.ContextVar("current_profile", default=None)
+
+
+# helper function, frame label of a code object in the collapsed stacks: function (file:line), cached since the
+# same code objects are sampled over and over
+@functools.lru_cache(maxsize=4096)
+def get_label(code):
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+# helper function, checks if a thread is waiting (for work, a lock or i/o) rather than running code
+def is_idle(frame):
+    filename = os.path.basename(frame.f_code.co_filename)
+    return (filename == "threading.py" and frame.f_code.co_name in ("wait", "_wait_for_tstate_lock")) or (filename == "selectors.py" and frame.f_code.co_name in ("select", "poll"))
+
+
+# sampling profiler: a thread that records the stack of every other running thread of the process (or only of
+# thread_ids, more can be added with add_thread) every interval seconds, threads waiting for work are skipped
+# stacks are cut below root_frame if it is given, which leaves out how the code being profiled was called
+# the stacks are counted in the collapsed format of flamegraph.pl (frames from the root separated by ";",
+# rooted at the thread name), which speedscope and other flamegraph viewers read as well
+class StackSampler():
+    def __init__(self, interval=SAMPLE_INTERVAL, thread_ids=None, root_frame=None):
+        self.interval = interval
+        self.thread_ids = thread_ids
+        self.root_frame = root_frame
+        self.counts = Counter() # collapsed stack -> number of samples
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    # samples the thread as well (if only some threads are sampled), or no longer
+    def add_thread(self, thread_id):
+        with self.lock:
+            self.thread_ids = self.thread_ids | {thread_id}
+
+    def remove_thread(self, thread_id):
+        with self.lock:
+            self.thread_ids = self.thread_ids - {thread_id}
+
+    # records the current stack of each thread
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        thread_ids = self.thread_ids
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == self.thread.ident or (thread_ids is not None and thread_id not in thread_ids):
+                continue
+            if is_idle(frame):
+                continue
+            stack = []
+            while frame is not None and frame is not self.root_frame:
+                stack.append(get_label(frame.f_code))
+                frame = frame.f_back
+            if frame is None:
+                stack.append(names.get(thread_id, "thread"))
+            with self.lock:
+                self.counts[";".join(reversed(stack))] += 1
+
+    # adds the stacks sampled elsewhere (e.g. in a worker process) under the root frame
+    def add_stacks(self, counts, root):
+        with self.lock:
+            for stack, count in counts.items():
+                self.counts[f"{root};{stack}"] += count
+
+    # the samples in the collapsed format, one "stack count" line per stack
+    def render(self):
+        with self.lock:
+            return "".join(f"{stack} {count}\n" for stack, count in sorted(self.counts.items()))
+
+
+# profiles fn(*args) in this thread, returns its result and the sampled stacks, rooted at fn (used in worker processes)
+# the gil is handed over as often as samples are taken while it runs, so python code is sampled at the full rate
+def profile_call(fn, args):
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(min(switch_interval, SAMPLE_INTERVAL))
+    sampler = StackSampler(thread_ids={threading.get_ident()}, root_frame=sys._getframe()).start()
+    try:
+        result = fn(*args)
+    finally:
+        sampler.stop()
+        sys.setswitchinterval(switch_interval)
+    return result, dict(sampler.counts)
+
+# writes the profile of a request to the profile directory: the stacks (name.folded) and the route, parameters
+# and timing of the request (name.json)
+def save_profile(profile_dir, name, sampler, metadata):
+    os.makedirs(profile_dir, exist_ok=True)
+    with open(os.path.join(profile_dir, f"{name}.folded"), "w") as f:
+        f.write(sampler.render())
+    with open(os.path.join(profile_dir, f"{name}.json"), "w") as f:
+        json.dump({**metadata, "samples": sum(sampler.counts.values()), "interval": sampler.interval}, f, indent=2, default=str)
+
+
+# wraps a route's endpoint so that, when the request is profiled, the thread it runs in is sampled from when it
+# starts: a threadpool thread for plain functions, until they return (the thread then serves other requests), or
+# the event loop thread for coroutines, until the request is done (streamed bodies are sent from it)
+def record_thread(endpoint):
+    if asyncio.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            profile = current_profile.get()
+            if profile is not None:
+                profile.add_thread(threading.get_ident())
+            return await endpoint(*args, **kwargs)
+    else:
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            profile = current_profile.get()
+            if profile is None:
+                return endpoint(*args, **kwargs)
+            profile.add_thread(threading.get_ident())
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                profile.remove_thread(threading.get_ident())
+    return wrapper
+
+
+# adds a middleware to the fastapi app profiling the requests that ask for it (or are sampled), see PROFILE_DIR
+# a profile only samples the threads the request's handler runs in (see record_thread), not the other requests
+# being served at the same time, so it must be added before the routes are defined
+# when profiling is not set up nothing is added, so requests do not pay anything for it
+def add_profiling(app, profile_dir=PROFILE_DIR, sample_rate=PROFILE_SAMPLE_RATE, admin_token=ADMIN_TOKEN):
+    if not profile_dir:
+        return
+    from fastapi import Request
+    from fastapi.routing import APIRoute
+
+    class ProfiledRoute(APIRoute):
+        def __init__(self, path, endpoint, **kwargs):
+            super().__init__(path, record_thread(endpoint), **kwargs)
+
+    app.router.route_class = ProfiledRoute
+
+    @app.middleware("http")
+    async def profile_request(request: Request, call_next):
+        requested = "x-profile" in request.headers and (admin_token is None or request.headers.get("x-admin-token") == admin_token)
+        if not requested and not (sample_rate and random.random() < sample_rate):
+            return await call_next(request)
+
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        sampler = StackSampler(thread_ids=set()).start()
+        start = time.perf_counter()
+        token = current_profile.set(sampler)
+        try:
+            response = await call_next(request)
+        except BaseException:
+            sampler.stop()
+            raise
+        finally:
+            current_profile.reset(token)
+
+        # streamed responses are computed while they are sent, the profile covers the whole body
+        body_iterator = response.body_iterator
+        async def profiled_body():
+            try:
+                async for chunk in body_iterator:
+                    yield chunk
+            finally:
+                sampler.stop()
+                route = request.scope.get("route")
+                save_profile(profile_dir, name, sampler, {
+                    "method": request.method,
+                    "route": getattr(route, "path", None),
+                    "path": request.url.path,
+                    "path_params": request.scope.get("path_params", {}),
+                    "query_params": request.query_params.multi_items(),
+                    "status": response.status_code,
+                    "trigger": "header" if requested else "sampled",
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                    "seconds": time.perf_counter() - start,
+                })
+        response.body_iterator = profiled_body()
+        response.headers["X-Profile"] = name
+        return response